@@ -0,0 +1,145 @@
+# bench/__main__.py
+#
+# Copyright (C) 2017 Brian C. Lane
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import argparse
+from datetime import datetime
+from glob import glob
+import json
+import multiprocessing as mp
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import traceback
+
+from .benchmarks import BENCHMARKS
+from .mktree import make_tree
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run the strix benchmarks")
+    parser.add_argument("--base-dir", help="Use an existing media tree instead of a generated one")
+    parser.add_argument("--cameras", type=int, default=4)
+    parser.add_argument("--days", type=int, default=7)
+    parser.add_argument("--events", type=int, default=50, help="Events per camera per day")
+    parser.add_argument("--images", type=int, default=10, help="Images per event")
+    parser.add_argument("--repeat", type=int, default=5, help="Times to run each benchmark")
+    parser.add_argument("--page-size", type=int, default=25, help="Events per page")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per /api/events run")
+    parser.add_argument("--process-events", type=int, default=10, help="Events per process_event run")
+    parser.add_argument("--writes", type=int, default=5000, help="Events added by the snapshot writer")
+    parser.add_argument("--readers", type=int, default=4, help="Snapshot reader threads")
+    parser.add_argument("--only", action="append", choices=list(BENCHMARKS),
+                        help="Only run this benchmark, may be repeated")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Compare the results to a previous JSON file")
+    return parser.parse_args()
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"],
+                                       cwd=os.path.dirname(__file__), stderr=subprocess.DEVNULL,
+                                       text=True).strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def run_one(name, opts, tx):
+    """
+    Run a benchmark in its own process so that they don't share the EventCache
+    """
+    try:
+        tx.send(BENCHMARKS[name](opts))
+    except Exception:
+        traceback.print_exc()
+        tx.send(None)
+    tx.close()
+
+
+def print_results(results, baseline=None):
+    print(f"{'benchmark':<34} {'ops':>7} {'median ms':>11} {'per op us':>11} {'ops/s':>11}", end="")
+    print(f" {'change':>8}" if baseline else "")
+    for name, result in results.items():
+        per_op = result["median"] / max(1, result["ops"])
+        print(f"{name:<34} {result['ops']:>7} {result['median']*1000:>11.2f} "
+              f"{per_op*1e6:>11.1f} {1/per_op if per_op else 0:>11.0f}", end="")
+        if baseline:
+            old = baseline.get(name)
+            if old and old["ops"] == result["ops"] and old["median"]:
+                print(f" {(result['median'] / old['median'] - 1) * 100:>+7.1f}%")
+            else:
+                print(f" {'-':>8}")
+        else:
+            print()
+
+
+def main():
+    opts = parse_args()
+
+    baseline = None
+    if opts.compare:
+        with open(opts.compare) as f:
+            baseline = json.load(f)
+
+    tmp = None
+    if not opts.base_dir:
+        tmp = tempfile.mkdtemp(prefix="strix-bench-")
+        opts.base_dir = os.path.join(tmp, "media")
+        print(f"Creating {opts.cameras}x{opts.days}x{opts.events} events in {opts.base_dir}")
+        make_tree(opts.base_dir, opts.cameras, opts.days, opts.events, opts.images)
+    opts.total_events = len(glob(os.path.join(opts.base_dir, "Camera*/????-??-??/??-??-??")))
+
+    results = {}
+    try:
+        for name in opts.only or BENCHMARKS:
+            print(f"Running {name}...", file=sys.stderr)
+            rx, tx = mp.Pipe(False)
+            proc = mp.Process(name=f"bench-{name}", target=run_one, args=(name, opts, tx))
+            proc.start()
+            tx.close()
+            try:
+                result = rx.recv()
+            except EOFError:
+                result = None
+            proc.join()
+            if result is None:
+                print(f"{name} failed", file=sys.stderr)
+                continue
+            for key, value in result.items():
+                results[f"{name}.{key}"] = value
+    finally:
+        if tmp:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    print_results(results, baseline and baseline["results"])
+
+    if opts.output:
+        params = {k: v for k, v in vars(opts).items() if k not in ("base_dir", "only", "output", "compare")}
+        with open(opts.output, "w") as f:
+            json.dump({
+                "date": datetime.now().isoformat(),
+                "commit": git_commit(),
+                "python": platform.python_version(),
+                "cpus": os.cpu_count(),
+                "params": params,
+                "results": results,
+            }, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
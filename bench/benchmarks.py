@@ -0,0 +1,331 @@
+# bench/benchmarks.py
+#
+# Copyright (C) 2017 Brian C. Lane
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from datetime import datetime, timedelta
+from glob import glob
+import http.client
+from itertools import count
+import multiprocessing as mp
+import os
+import shutil
+import socket
+import statistics
+import tempfile
+import time
+
+from gevent import monkey
+import structlog
+
+from strix import api, events, logger, queue
+from strix.eventdb import EventDB
+
+from .mktree import FrameWriter, make_queued_event
+
+# Benchmarks are registered here by @benchmark, in the order they are run
+BENCHMARKS = {}
+
+# process_event() runs ffmpeg from the PATH, this one just creates the output file
+STUB_FFMPEG = """#!/bin/sh
+for last; do :; done
+: > "$last"
+"""
+
+def benchmark(fn):
+    BENCHMARKS[fn.__name__] = fn
+    return fn
+
+
+def timeit(fn, repeat, ops=1, setup=None):
+    """
+    Run fn repeat times, calling setup before each run without timing it
+
+    Returns a dict with the min and median time of a run, and the number of
+    operations it did, for the results.
+    """
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {"ops": ops, "min": min(times), "median": statistics.median(times)}
+
+
+def bench_log():
+    """
+    Return a structlog logger, the benchmarks leave the logging unconfigured so
+    that only warnings and errors are output
+    """
+    return structlog.get_logger("bench")
+
+
+def remove_details(base_dir):
+    for path in glob(os.path.join(base_dir, "Camera*/*/*/.details.json")):
+        os.unlink(path)
+
+
+def reset_cache():
+    events.EventCache.__init__()
+
+
+@benchmark
+def preload(opts):
+    """
+    preload_cache() with and without the .details.json files, using 1 and max_cores jobs,
+    and from the EventDB
+    """
+    log = bench_log()
+    results = {}
+    for jobs in sorted(set([1, queue.max_cores()])):
+        results[f"cold_jobs{jobs}"] = timeit(lambda: events.preload_cache(log, opts.base_dir, jobs),
+                                             opts.repeat, opts.total_events,
+                                             setup=lambda: (remove_details(opts.base_dir), reset_cache()))
+        results[f"warm_jobs{jobs}"] = timeit(lambda: events.preload_cache(log, opts.base_dir, jobs),
+                                             opts.repeat, opts.total_events, setup=reset_cache)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        EventDB.open(os.path.join(tmp, "events.db"))
+        reset_cache()
+        events.preload_cache(log, opts.base_dir, 1)
+        results["eventdb"] = timeit(lambda: events.preload_cache(log, opts.base_dir, 1),
+                                    opts.repeat, opts.total_events, setup=reset_cache)
+    return results
+
+
+@benchmark
+def event_details(opts):
+    """
+    event_details() for every event, cold reads the images and writes the
+    .details.json, warm is from the EventCache
+    """
+    log = bench_log()
+    event_paths = sorted(glob(os.path.join(opts.base_dir, "Camera*/*/??-??-??")))
+
+    def run():
+        for event_path in event_paths:
+            events.event_details(log, event_path)
+
+    return {
+        "cold": timeit(run, opts.repeat, len(event_paths),
+                       setup=lambda: (remove_details(opts.base_dir), reset_cache())),
+        "warm": timeit(run, opts.repeat, len(event_paths)),
+    }
+
+
+@benchmark
+def camera_events(opts):
+    """
+    Page through all of Camera1's events using offset and using cursors
+    """
+    log = bench_log()
+    events.preload_cache(log, opts.base_dir, queue.max_cores())
+    start = datetime(1985, 10, 26, 1, 22, 0)
+    end = datetime.now()
+    total = len(events.EventCache.events("Camera1"))
+    pages = -(-total // opts.page_size)
+
+    def offset_pages():
+        for page in range(pages):
+            events.camera_events(log, opts.base_dir, "Camera1", start, end,
+                                 page * opts.page_size, opts.page_size)
+
+    def cursor_pages():
+        before = None
+        while True:
+            page = events.camera_events(log, opts.base_dir, "Camera1", start, end,
+                                        0, opts.page_size, before)
+            if len(page) < opts.page_size:
+                break
+            before = events.parse_cursor(events.make_cursor(page[0]["event_path"], page[0]))
+
+    return {
+        "offset": timeit(offset_pages, opts.repeat, pages),
+        "cursor": timeit(cursor_pages, opts.repeat, pages),
+    }
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@benchmark
+def api_events(opts):
+    """
+    Requests per second for /api/events through bottle and gevent
+
+    miss requests a different page each time, hit repeats the same request
+    and conditional is answered with a 304.
+    """
+    log = bench_log()
+    events.preload_cache(log, opts.base_dir, queue.max_cores())
+
+    with tempfile.TemporaryDirectory() as tmp:
+        logger_queue = mp.Queue(1000)
+        logger_quit = mp.Event()
+        logger_thread = mp.Process(name="logger-thread",
+                                   target=logger.listener,
+                                   args=(logger_queue, logger_quit, os.path.join(tmp, "strix.log")))
+        logger_thread.start()
+
+        port = free_port()
+        queue_rx, _queue_tx = mp.Pipe(False)
+        api_thread = mp.Process(name="api-thread",
+                                target=api.run_api,
+                                args=(logger_queue, opts.base_dir, [], "127.0.0.1", port, False, queue_rx))
+        api_thread.start()
+
+        # Wait for it to start listening
+        for _ in range(100):
+            try:
+                socket.create_connection(("127.0.0.1", port)).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+
+        cameras = ",".join(sorted(os.path.basename(c) for c in glob(os.path.join(opts.base_dir, "Camera*"))))
+        conn = http.client.HTTPConnection("127.0.0.1", port)
+
+        def get(url, headers=None):
+            conn.request("GET", url, headers=headers or {})
+            resp = conn.getresponse()
+            resp.read()
+            return resp
+
+        etag = get(f"/api/events/{cameras}").getheader("ETag")
+        n = opts.requests
+
+        # Each run uses new offsets so that they are not in the response cache
+        offsets = count()
+
+        def miss():
+            for _ in range(n):
+                get(f"/api/events/{cameras}?offset={next(offsets)}&limit={opts.page_size}")
+
+        def hit():
+            for _ in range(n):
+                get(f"/api/events/{cameras}?limit={opts.page_size}")
+
+        def conditional():
+            for _ in range(n):
+                get(f"/api/events/{cameras}?limit={opts.page_size}", {"If-None-Match": etag})
+
+        try:
+            return {
+                "miss": timeit(miss, opts.repeat, n),
+                "hit": timeit(hit, opts.repeat, n),
+                "conditional": timeit(conditional, opts.repeat, n),
+            }
+        finally:
+            conn.close()
+            api_thread.terminate()
+            api_thread.join()
+            logger_queue.put(None)
+            logger_thread.join()
+
+
+class DiscardTx:
+    """
+    Stands in for the queue_tx Pipe
+    """
+    def send(self, _obj):
+        pass
+
+
+@benchmark
+def process_event(opts):
+    """
+    process_event() with a stub ffmpeg, this is the time spent in strix itself
+    """
+    log = bench_log()
+    with tempfile.TemporaryDirectory() as tmp:
+        bin_dir = os.path.join(tmp, "bin")
+        os.mkdir(bin_dir)
+        with open(os.path.join(bin_dir, "ffmpeg"), "w") as f:
+            f.write(STUB_FFMPEG)
+        os.chmod(os.path.join(bin_dir, "ffmpeg"), 0o755)
+        os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+
+        base_dir = os.path.join(tmp, "media")
+        frames = FrameWriter()
+        queued = []
+
+        def setup():
+            shutil.rmtree(base_dir, ignore_errors=True)
+            os.makedirs(os.path.join(base_dir, "queue"))
+            queued[:] = [make_queued_event(frames, base_dir, 1, i, opts.images)
+                         for i in range(opts.process_events)]
+
+        def run():
+            for event in queued:
+                queue.process_event(log, base_dir, event, DiscardTx())
+
+        return {"stub_ffmpeg": timeit(run, opts.repeat, opts.process_events, setup=setup)}
+
+
+@benchmark
+def snapshot_readers(opts):
+    """
+    EventCache readers in native threads running against a writer adding events
+    """
+    reset_cache()
+    start_new_thread = monkey.get_original("_thread", "start_new_thread")
+    sleep = monkey.get_original("time", "sleep")
+    t0 = datetime(2020, 1, 1)
+    n = opts.writes
+    results = {}
+
+    def write():
+        for i in range(n):
+            start = t0 + timedelta(minutes=i)
+            event_path = f"/snapshot/Camera{i % 4 + 1}/{start:%Y-%m-%d}/{start:%H-%M-%S}"
+            events.EventCache.set(event_path, {"start": start, "end": start, "video": "video.m4v",
+                                               "debug_video": "debug/video.m4v",
+                                               "thumbnail": "thumbnail.jpg", "saved": False})
+
+    stop = []
+    reads = []
+    errors = []
+
+    def read():
+        count = 0
+        while not stop:
+            try:
+                snapshot = events.EventCache.snapshot()
+                for event_path in snapshot.camera_range("Camera1", t0, datetime.now(), 0, 10):
+                    snapshot.get(event_path)
+                count += 1
+            except Exception as e:
+                errors.append(e)
+                break
+        reads.append(count)
+
+    for _ in range(opts.readers):
+        start_new_thread(read, ())
+    start = time.perf_counter()
+    write()
+    elapsed = time.perf_counter() - start
+    stop.append(True)
+    while len(reads) < opts.readers:
+        sleep(0.01)
+    if errors:
+        raise RuntimeError(f"Snapshot reader failed: {errors[0]!r}")
+
+    results["writes"] = {"ops": n, "min": elapsed, "median": elapsed}
+    results["reads"] = {"ops": sum(reads), "min": elapsed, "median": elapsed}
+    return results
@@ -0,0 +1,142 @@
+# bench/mktree.py
+#
+# Copyright (C) 2017 Brian C. Lane
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import argparse
+from datetime import datetime, timedelta
+import io
+import os
+import random
+
+from PIL import Image
+
+# EXIF tag holding motion's <changed>-<noise>-<width>-<height>-<X>-<Y>
+EXIF_IMAGE_DESCRIPTION = 0x010e
+
+# Size of the generated frames, they are kept small so that the tree is fast to create
+FRAME_SIZE = (160, 120)
+
+def motion_description(rng):
+    """
+    Return a random motion style ImageDescription
+    """
+    width = rng.randint(4, FRAME_SIZE[0] // 2)
+    height = rng.randint(4, FRAME_SIZE[1] // 2)
+    return "%d-%d-%d-%d-%d-%d" % (rng.randint(0, 20000), rng.randint(0, 32), width, height,
+                                  rng.randint(width // 2, FRAME_SIZE[0] - width // 2),
+                                  rng.randint(height // 2, FRAME_SIZE[1] - height // 2))
+
+
+class FrameWriter:
+    """
+    Write small JPEGs with a motion style EXIF ImageDescription
+
+    The image data is encoded once, only the EXIF changes between frames.
+    """
+    def __init__(self, seed=0):
+        self._rng = random.Random(seed)
+        im = Image.new("RGB", FRAME_SIZE, (40, 80, 120))
+        buf = io.BytesIO()
+        exif = Image.Exif()
+        exif[EXIF_IMAGE_DESCRIPTION] = "X" * 31
+        im.save(buf, "JPEG", exif=exif)
+        self._jpeg = buf.getvalue()
+        self._marker = b"X" * 31 + b"\0"
+
+    def write(self, path):
+        # The description is padded to the same length so the EXIF offsets stay valid
+        desc = motion_description(self._rng).encode().ljust(len(self._marker), b"\0")
+        with open(path, "wb") as f:
+            f.write(self._jpeg.replace(self._marker, desc, 1))
+
+
+def make_event(frames, event_path, start, images, processed=True):
+    """
+    Create an event directory with images frames, one per second from start
+
+    Processed events also get the debug images, videos and thumbnail that
+    process_event() leaves behind. The videos are empty files.
+    """
+    debug_path = os.path.join(event_path, "debug")
+    os.makedirs(debug_path if processed else event_path, exist_ok=True)
+    for i in range(images):
+        name = (start + timedelta(seconds=i)).strftime("%H-%M-%S") + "-%02d" % (i % 100)
+        frames.write(os.path.join(event_path, name + ".jpg"))
+        frames.write(os.path.join(debug_path if processed else event_path, name + "m.jpg"))
+
+    if processed:
+        for path in [event_path, debug_path]:
+            open(os.path.join(path, "video.m4v"), "w").close()
+        frames.write(os.path.join(event_path, "thumbnail.jpg"))
+
+
+def make_tree(base_dir, cameras, days, events, images, seed=0, now=None):
+    """
+    Create a motion media tree of cameras x days x events processed events
+
+    The newest day is today, the events are spread evenly across each day.
+    Returns a list of the event paths.
+    """
+    now = now or datetime.now()
+    frames = FrameWriter(seed)
+    for d in ["queue", "delete_queue"]:
+        os.makedirs(os.path.join(base_dir, d), exist_ok=True)
+
+    event_paths = []
+    step = timedelta(days=1) / events
+    for camera in range(1, cameras + 1):
+        for day in range(days):
+            midnight = (now - timedelta(days=day)).replace(hour=0, minute=0, second=0, microsecond=0)
+            for e in range(events):
+                start = midnight + step * e
+                event_path = os.path.join(base_dir, f"Camera{camera}",
+                                          start.strftime("%Y-%m-%d"), start.strftime("%H-%M-%S"))
+                make_event(frames, event_path, start, images)
+                event_paths.append(event_path)
+    return event_paths
+
+
+def make_queued_event(frames, base_dir, camera, number, images, now=None):
+    """
+    Create an unprocessed event and its queue file, the way motion leaves them
+
+    Returns the queue entry name that is passed to process_event()
+    """
+    now = now or datetime.now()
+    day = now.strftime("%Y-%m-%d")
+    event_path = os.path.join(base_dir, f"Camera{camera}", day, str(number))
+    make_event(frames, event_path, now, images, processed=False)
+
+    event = f"Camera{camera}_{day}_{number}"
+    open(os.path.join(base_dir, "queue", event), "w").close()
+    return event
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create a synthetic motion media tree")
+    parser.add_argument("base_dir", help="Directory to create the tree in")
+    parser.add_argument("--cameras", type=int, default=4)
+    parser.add_argument("--days", type=int, default=7)
+    parser.add_argument("--events", type=int, default=50, help="Events per camera per day")
+    parser.add_argument("--images", type=int, default=10, help="Images per event")
+    parser.add_argument("--seed", type=int, default=0)
+    opts = parser.parse_args()
+
+    paths = make_tree(opts.base_dir, opts.cameras, opts.days, opts.events, opts.images, opts.seed)
+    print(f"Created {len(paths)} events in {opts.base_dir}")
+
+
+if __name__ == "__main__":
+    main()
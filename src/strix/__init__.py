@@ -21,6 +21,8 @@ import time
 
 from . import api
 from . import cmdline
+from . import deleter
+from . import eventdb
 from . import events
 from . import queue
 from . import logger
@@ -110,7 +112,8 @@ def run():
         return False
 
     # Start logger thread
-    logger_queue = mp.JoinableQueue()
+    logger.configure(opts.log_debug_policy)
+    logger_queue = mp.Queue(opts.log_queue_size)
     logger_quit = mp.Event()
     logger_thread = mp.Process(name="logger-thread",
                                 target=logger.listener,
@@ -131,8 +134,19 @@ def run():
     events.EventCache.base_dir(base_dir)
     events.EventCache.keep(opts.keep_days)
     events.EventCache.check_cache(opts.check_cache)
-    events.EventCache.cleanup_dq()
-    events.preload_cache(log, base_dir)
+    if opts.event_db:
+        eventdb.EventDB.open(os.path.join(base_dir, "events.db"))
+    events.preload_cache(log, base_dir, opts.preload_jobs or opts.max_cores, opts.backfill_thumbnails)
+    # Each process opens its own connection
+    eventdb.EventDB.close()
+
+    # Start the delete thread, it also removes anything left in the delete_queue by a previous run
+    delete_quit = mp.Event()
+    delete_thread = mp.Process(name="delete-thread",
+                               target=deleter.delete_worker,
+                               args=(logger_queue, base_dir, delete_quit, opts.delete_rate))
+    delete_thread.start()
+    running_threads += [(delete_thread, delete_quit)]
 
     # Start queue monitor and processing thread (starts its own Multiprocessing threads)
     queue_path = os.path.abspath(os.path.join(base_dir, "queue/"))
@@ -141,9 +155,13 @@ def run():
         return False
     queue_quit = mp.Event()
     queue_rx, queue_tx = mp.Pipe(False)
+    metrics_rx, metrics_tx = mp.Pipe(False)
     queue_thread = mp.Process(name="queue-thread",
                               target=queue.monitor_queue,
-                              args=(logger_queue, base_dir, queue_quit, opts.max_cores, queue_tx))
+                              args=(logger_queue, base_dir, queue_quit, opts.max_cores, queue_tx,
+                                    opts.queue_order, opts.queue_size, opts.timelapse, metrics_tx,
+                                    queue.video_args(opts.video_codec, opts.video_bitrate, opts.video_preset),
+                                    opts.incremental))
     queue_thread.start()
     running_threads += [(queue_thread, queue_quit)]
 
@@ -151,7 +169,8 @@ def run():
     api_quit = mp.Event()
     api_thread = mp.Process(name="api-thread",
                             target=api.run_api,
-                            args=(logger_queue, base_dir, cameras, opts.host, opts.port, opts.debug, queue_rx))
+                            args=(logger_queue, base_dir, cameras, opts.host, opts.port, opts.debug, queue_rx,
+                                  metrics_rx))
     api_thread.start()
     running_threads += [(api_thread, api_quit)]
 
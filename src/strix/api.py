@@ -16,21 +16,30 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from gevent import monkey; monkey.patch_all()
 from datetime import datetime
-from glob import glob
 import os
+import re
+import stat
+import time
 
 # Fix mimetypes so that it recognized m4v as video/mp4
 import mimetypes
 mimetypes.add_type("video/mp4", ".m4v")
 
 import bottle
-from bottle import abort, install, route, run, static_file, request, Response, JSONPlugin
-from bottle import template
+from bottle import abort, install, route, run, static_file, request, response, Response, JSONPlugin
+from bottle import template, http_date, parse_date
+from collections import OrderedDict
+import gevent
+from gevent.pywsgi import WSGIHandler
 from json import dumps
-from threading import Thread
+from queue import Empty, Full, Queue
+import socket
+from threading import Lock, Thread
 
 from . import logger
-from .events import camera_events, EventCache, queue_events
+from .events import camera_events, event_camera, EventCache, make_cursor, parse_cursor, queue_events, timeline_events
+from .metrics import Metrics, receive_metrics
+from .thumbnail import is_thumbnail
 
 bottle.TEMPLATE_PATH.insert(0, os.path.dirname(__file__)+"/ui/")
 
@@ -38,15 +47,163 @@ TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 def timestr_to_dt(rfc_str):
     return datetime.strptime(rfc_str, TIME_FORMAT)
 
-def run_api(logging_queue, base_dir, cameras, host, port, debug, queue_rx):
+# Processed events are in Camera*/YYYY-MM-DD/HH-MM-SS/ and do not change
+EVENT_MEDIA_RE = re.compile(r"^Camera\d+/\d{4}-\d\d-\d\d/\d\d-\d\d-\d\d/")
+EVENT_MEDIA_CACHE = "public, max-age=31536000, immutable"
+
+# Directory listings are sent in chunks of this many names
+LISTING_CHUNK = 1000
+
+# Seconds between keepalive comments on idle /api/events/stream connections
+STREAM_KEEPALIVE = 15
+
+# Different for each run so that ETags from a previous run do not match
+ETAG_EPOCH = int(time.time())
+
+def not_modified(etag, last_modified):
+    """
+    Return True if the request's conditional headers match the etag or last_modified
+
+    last_modified is a unix timestamp. It is not truncated to whole seconds like the
+    Last-Modified header, there may have been changes after the header's time in the
+    same second.
+    """
+    # request.headers is a bottle.WSGIHeaderDict which pylint doesn't understand
+    # pylint: disable=no-member
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match:
+        return if_none_match.strip() == "*" or etag in (t.strip() for t in if_none_match.split(","))
+
+    ims = request.headers.get("If-Modified-Since")
+    if ims:
+        ims = parse_date(ims.split(";")[0].strip())
+        return ims is not None and ims > last_modified
+    return False
+
+class ResponseCache:
+    """
+    LRU cache of serialized camera_events() results, and of directory listings
+
+    The keys include the camera's EventCache generation, or the directory's
+    mtime, so an entry stops being used as soon as it changes and is evicted
+    later.
+    """
+    def __init__(self, maxsize=256):
+        self._maxsize = maxsize
+        self._cache = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._cache.get(key)
+            if value is not None:
+                self._cache.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._cache[key] = value
+            self._cache.move_to_end(key)
+            while len(self._cache) > self._maxsize:
+                self._cache.popitem(last=False)
+
+
+class EventBroadcaster:
+    """
+    Send new events to the /api/events/stream subscribers
+
+    Each subscriber has its own bounded Queue, a subscriber that falls too
+    far behind misses events instead of holding up the others.
+    """
+    def __init__(self, maxsize=100):
+        self._maxsize = maxsize
+        self._subscribers = set()
+        self._lock = Lock()
+
+    def subscribe(self):
+        q = Queue(self._maxsize)
+        with self._lock:
+            self._subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subscribers.discard(q)
+
+    def publish(self, event_path, details):
+        # Serialize it once for all of the subscribers
+        camera = event_path.rsplit("/", 3)[-3]
+        data = dumps({"camera": camera, "event": details}, default=str)
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait((camera, data))
+            except Full:
+                pass
+
+
+class NoDelayHandler(WSGIHandler):
+    """
+    Turn off Nagle's algorithm on the client connections
+
+    gevent writes the headers and the body separately, without TCP_NODELAY the
+    body waits for the client to ACK the headers. With delayed ACKs that adds
+    40ms to every request on a keep-alive connection.
+    """
+    def handle(self):
+        try:
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            pass
+        super().handle()
+
+
+class MetricsPlugin:
+    """
+    Count the requests and time how long they take, by route
+    """
+    name = "metrics"
+    api = 2
+
+    def apply(self, callback, route):
+        rule = route.rule
+
+        def wrapper(*args, **kwargs):
+            start = time.monotonic()
+            status = 500
+            try:
+                body = callback(*args, **kwargs)
+                status = body.status_code if isinstance(body, bottle.HTTPResponse) else response.status_code
+                return body
+            except bottle.HTTPResponse as e:
+                status = e.status_code
+                raise
+            finally:
+                Metrics.inc("strix_http_requests_total", route=rule, method=request.method, status=status)
+                Metrics.observe("strix_http_request_seconds", time.monotonic() - start, route=rule)
+        return wrapper
+
+
+def run_api(logging_queue, base_dir, cameras, host, port, debug, queue_rx, metrics_rx=None):
     log = logger.log(logging_queue)
     log.info("Starting API", base_dir=base_dir, cameras=cameras, host=host, port=port, debug=debug)
     EventCache.logger(log)
+    # The expire thread is a greenlet, its file moves and EventDB writes are run on a native thread
+    EventCache.start_expire(gevent.get_hub().threadpool.apply)
 
-    # Listen to queue_rx for new events
-    th = Thread(target=queue_events, args=(log, queue_rx))
+    # Listen to queue_rx for new events, passing them to the stream subscribers
+    broadcaster = EventBroadcaster()
+    th = Thread(target=queue_events, args=(log, queue_rx, broadcaster.publish))
     th.start()
 
+    # The queue process sends its metrics totals over metrics_rx
+    if metrics_rx:
+        Thread(target=receive_metrics, args=(metrics_rx, "queue"), daemon=True).start()
+
+    response_cache = ResponseCache()
+    listing_cache = ResponseCache(128)
+
     @route('/')
     @route('/<filename>')
     def serve_root(filename="index.html"):
@@ -54,20 +211,93 @@ def run_api(logging_queue, base_dir, cameras, host, port, debug, queue_rx):
 
     @route('/motion/<filepath:path>')
     def serve_motion(filepath):
-        if os.path.isfile(base_dir + "/" + filepath):
-            return static_file(filepath, root=base_dir)
-
         path = os.path.normpath(base_dir + os.path.normpath("/" + filepath))
-        if not os.path.isdir(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            abort(404)
+
+        if stat.S_ISREG(st.st_mode):
+            # static_file handles the Last-Modified and ETag validators
+            resp = static_file(filepath, root=base_dir)
+            if EVENT_MEDIA_RE.match(os.path.relpath(path, base_dir)):
+                resp.set_header("Cache-Control", EVENT_MEDIA_CACHE)
+            return resp
+        if not stat.S_ISDIR(st.st_mode):
             abort(404)
 
-        listing = sorted([os.path.basename(f) for f in glob(path + "/*.jpg")])
-        return template("dirlist.tmpl", listing=listing)
+        # The images in a directory only change when its mtime does
+        key = (path, st.st_mtime_ns)
+        listing = listing_cache.get(key)
+        if listing is None:
+            with os.scandir(path) as it:
+                # The thumbnails and sprite sheets aren't frames of the event
+                listing = sorted(e.name for e in it if e.name.endswith(".jpg") and not is_thumbnail(e.name))
+            listing_cache.set(key, listing)
+
+        # request.query is a bottle.MultiDict which pylint doesn't understand
+        # pylint: disable=no-member
+        chunks = range(0, max(1, len(listing)), LISTING_CHUNK)
+        if request.query.get("format") == "json":
+            response.content_type = "application/json"
+
+            def json_listing():
+                yield '{"images": ['
+                for i in chunks:
+                    yield ("," if i else "") + ",".join(dumps(name) for name in listing[i:i+LISTING_CHUNK])
+                yield ']}'
+            return json_listing()
+
+        def html_listing():
+            for i in chunks:
+                yield template("dirlist.tmpl", listing=listing[i:i+LISTING_CHUNK],
+                               head=i == 0, tail=i == chunks[-1])
+        return html_listing()
 
     @route('/api/cameras/list')
     def serve_cameras_list() -> Response:
         return {"cameras": cameras}
 
+    @route('/api/metrics')
+    def serve_metrics():
+        for camera, records in EventCache.snapshot().records.items():
+            Metrics.set("strix_event_cache_events", len(records), camera=camera)
+        response.content_type = "text/plain; version=0.0.4; charset=utf-8"
+        return Metrics.render()
+
+    @route('/api/events/stream')
+    def serve_events_stream():
+        """
+        Push new events to the client as Server-Sent Events
+
+        ?cameras=Camera1,Camera2 limits it to those cameras, the default is all of them
+        """
+        # request.query is a bottle.MultiDict which pylint doesn't understand
+        # pylint: disable=no-member
+        camera_list = set(c for c in request.query.get("cameras", "").split(",") if c)
+
+        response.content_type = "text/event-stream"
+        response.set_header("Cache-Control", "no-cache")
+        q = broadcaster.subscribe()
+
+        def stream():
+            try:
+                yield "retry: 5000\n\n"
+                while True:
+                    try:
+                        camera, data = q.get(timeout=STREAM_KEEPALIVE)
+                    except Empty:
+                        # Keep proxies from closing the idle connection
+                        yield ": keepalive\n\n"
+                        continue
+                    if camera_list and camera not in camera_list:
+                        continue
+                    yield f"event: event\ndata: {data}\n\n"
+            finally:
+                broadcaster.unsubscribe(q)
+
+        return stream()
+
     @route('/api/events/<cameras>')
     def serve_events(cameras):
         # request.query is a bottle.MultiDict which pylint doesn't understand
@@ -79,19 +309,79 @@ def run_api(logging_queue, base_dir, cameras, host, port, debug, queue_rx):
         camera_list = cameras.split(",")
 #        log.debug("serve_events", camera_list=camera_list, start=str(start), end=str(end), offset=offset, limit=limit)
 
-        events = {}
-        for camera in camera_list:
-            events[camera] = camera_events(log, base_dir, camera, start, end, offset, limit)
+        # cursor is a comma separated list of the cursors returned by a previous request
+        before = {}
+        for cursor in (c for c in request.query.get("cursor", "").split(",") if c):
+            try:
+                key = parse_cursor(cursor)
+                before[event_camera(key[1])] = key
+            except (KeyError, ValueError):
+                abort(400, "Invalid cursor")
+
+        # The events only change when the EventCache does
+        generation, modified = EventCache.generation()
+        etag = f'W/"{ETAG_EPOCH}-{generation}"'
+        response.set_header("Cache-Control", "no-cache")
+        response.set_header("ETag", etag)
+        response.set_header("Last-Modified", http_date(modified.timestamp()))
+        if not_modified(etag, modified.timestamp()):
+            response.status = 304
+            return ""
+
+        # Each camera's serialized events are cached until its events change,
+        # the default end of now is left out of the key since no events are newer.
+        end_key = end if request.query.get("end") is not None else None
+
+        # timeline merges the cameras' events into one list, offset, limit and the cursor
+        # apply to the merged list instead of to each camera.
+        if request.query.get("timeline", "0") not in ("", "0", "false"):
+            camera_list = list(dict.fromkeys(camera_list))
+            timeline_before = max(before.values()) if before else None
+            key = ("timeline", tuple((c, EventCache.generation(c)[0]) for c in camera_list),
+                   start, end_key, offset, limit, timeline_before)
+            cached = response_cache.get(key)
+            if cached is None:
+                page = timeline_events(log, base_dir, camera_list, start, end, offset, limit, timeline_before)
+
+                next_cursor = None
+                if limit > 0 and len(page) == limit:
+                    next_cursor = make_cursor(page[0]["event_path"], page[0])
+
+                cached = (dumps(page, default=str), dumps(next_cursor))
+                response_cache.set(key, cached)
+
+            response.content_type = "application/json"
+            return (f'{{"start": {dumps(str(start))}, "end": {dumps(str(end))}, '
+                    f'"offset": {offset}, "limit": {limit}, "cameras": {dumps(camera_list)}, '
+                    f'"events": {cached[0]}, "cursor": {cached[1]}}}')
+
+        events = []
+        cursors = []
+        for camera in dict.fromkeys(camera_list):
+            key = (camera, EventCache.generation(camera)[0], start, end_key, offset, limit, before.get(camera))
+            cached = response_cache.get(key)
+            if cached is None:
+                page = camera_events(log, base_dir, camera, start, end, offset, limit, before.get(camera))
+
+                # The oldest event is where the next page starts, if there may be more
+                next_cursor = None
+                if limit > 0 and len(page) == limit:
+                    next_cursor = make_cursor(page[0]["event_path"], page[0])
+
+                cached = (dumps(page, default=str), dumps(next_cursor))
+                response_cache.set(key, cached)
+            events.append(f"{dumps(camera)}: {cached[0]}")
+            cursors.append(f"{dumps(camera)}: {cached[1]}")
 
 #        log.debug("serve_events", events=events)
-        return {"start":    str(start),
-                "end":      str(end),
-                "offset":   offset,
-                "limit":    limit,
-                "events":   events}
+        response.content_type = "application/json"
+        return (f'{{"start": {dumps(str(start))}, "end": {dumps(str(end))}, '
+                f'"offset": {offset}, "limit": {limit}, "events": {{{", ".join(events)}}}, '
+                f'"cursors": {{{", ".join(cursors)}}}}}')
 
     # Use str as default in json dumps for objects like datetime
     install(JSONPlugin(json_dumps=lambda s: dumps(s, default=str)))
-    run(host=host, port=port, debug=debug, server="gevent")
+    install(MetricsPlugin())
+    run(host=host, port=port, debug=debug, server="gevent", handler_class=NoDelayHandler)
 
     th.join(30)
@@ -45,6 +45,15 @@ def parser(max_cores):
                           help="Path to logfile (/var/tmp/strix.log)",
                           metavar="LOGFILE",
                           default="/var/tmp/strix.log")
+    optional.add_argument("--log-queue-size",
+                          help="Maximum number of batches of log records waiting to be written (1000)",
+                          metavar="LOGQUEUESIZE",
+                          type=int,
+                          default=1000)
+    optional.add_argument("--log-debug-policy",
+                          help="What to do with debug records when the log queue is full (sample)",
+                          choices=["keep", "sample", "drop"],
+                          default="sample")
     optional.add_argument("--debug",
                           help="Output debug information",
                           action="store_true", default=False)
@@ -53,6 +62,42 @@ def parser(max_cores):
                           metavar="MAXCORES",
                           type=int,
                           default=max_cores)
+    optional.add_argument("--queue-order",
+                          help="Order to process queued events in (fifo)",
+                          choices=["fifo", "oldest"],
+                          default="fifo")
+    optional.add_argument("--queue-size",
+                          help="Maximum number of events to hold in the job queue (1000)",
+                          metavar="QUEUESIZE",
+                          type=int,
+                          default=1000)
+    optional.add_argument("--timelapse",
+                          help="How to pick the frames for long event timelapses (nth)",
+                          choices=["nth", "motion"],
+                          default="nth")
+    optional.add_argument("--video-codec",
+                          help="ffmpeg video encoder used for the event videos (h264)",
+                          metavar="CODEC",
+                          default="h264")
+    optional.add_argument("--video-bitrate",
+                          help="Bitrate of the event videos (2M)",
+                          metavar="BITRATE",
+                          default="2M")
+    optional.add_argument("--video-preset",
+                          help="ffmpeg encoder preset, eg. veryfast (the encoder's default)",
+                          metavar="PRESET",
+                          default=None)
+    optional.add_argument("--incremental",
+                          help="Encode the videos in segments while motion is recording the event",
+                          action="store_true", default=False)
+    optional.add_argument("--preload-jobs",
+                          help="Number of processes used to load the event cache at startup (MAXCORES)",
+                          metavar="JOBS",
+                          type=int,
+                          default=None)
+    optional.add_argument("--backfill-thumbnails",
+                          help="Create thumbnails for old events that are missing them at startup",
+                          action="store_true", default=False)
     optional.add_argument("--keep-days",
                           help="How many days of events to keep",
                           metavar="KEEPDAYS",
@@ -63,6 +108,14 @@ def parser(max_cores):
                           metavar="CHECKCACHE",
                           type=int,
                           default=60)
+    optional.add_argument("--delete-rate",
+                          help="Maximum number of expired files to delete per second, 0 is unlimited (200)",
+                          metavar="DELETERATE",
+                          type=int,
+                          default=200)
+    optional.add_argument("--event-db",
+                          help="Keep an index of the events in BASE_DIR/events.db to speed up startup",
+                          action="store_true", default=False)
 
 
     # add the show version option
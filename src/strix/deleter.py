@@ -0,0 +1,204 @@
+# deleter.py
+#
+# Copyright (C) 2017 Brian C. Lane
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import ctypes
+import ctypes.util
+import os
+import platform
+import time
+
+from . import logger
+from .inotify import InotifyWatcher, IN_CREATE, IN_MOVED_TO
+
+# ioprio_set(2) syscall numbers, it has no wrapper in the C library
+IOPRIO_SET = {
+    "x86_64": 251,
+    "i386": 289,
+    "i686": 289,
+    "aarch64": 30,
+    "armv7l": 314,
+    "ppc64le": 273,
+    "s390x": 282,
+}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+
+# Seconds between progress reports while deleting
+PROGRESS_INTERVAL = 30
+
+# Seconds between checks of the delete_queue for new work, and for being told to quit
+POLL_INTERVAL = 5
+
+# Seconds to wait before trying to delete a path again after it failed, doubling each time
+RETRY_MIN = 60
+RETRY_MAX = 60 * 60
+
+# Names starting with STAGING_PREFIX are still being filled by expire_events(),
+# they are left alone unless they are this old and were left by a previous run.
+STAGING_PREFIX = ".expire-"
+STAGING_MAX_AGE = 60 * 60
+
+def set_idle_priority(log):
+    """
+    Lower the cpu and io priority of this process
+
+    The io priority is only set on Linux, using the idle class so that the
+    disk is only used when nothing else needs it.
+    """
+    try:
+        os.nice(19)
+    except OSError as e:
+        log.debug("Failed to lower the cpu priority", exception=str(e))
+
+    nr = IOPRIO_SET.get(platform.machine())
+    libc_name = ctypes.util.find_library("c")
+    if nr is None or not libc_name:
+        log.info("Idle io priority is not available", machine=platform.machine())
+        return
+    libc = ctypes.CDLL(libc_name, use_errno=True)
+    if libc.syscall(nr, IOPRIO_WHO_PROCESS, 0, IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT) < 0:
+        log.info("Failed to set the idle io priority", errno=ctypes.get_errno())
+
+
+class RateLimit:
+    """
+    Sleep as needed to keep to rate calls of wait() per second, 0 is unlimited
+    """
+    def __init__(self, rate):
+        self._interval = 1 / rate if rate > 0 else 0
+        self._next = time.monotonic()
+
+    def wait(self):
+        if not self._interval:
+            return
+        now = time.monotonic()
+        # Don't save up more than a second's worth while idle
+        self._next = max(self._next, now - 1) + self._interval
+        if self._next - now > 0.05:
+            time.sleep(self._next - now)
+
+
+def delete_tree(log, path, limit, quit):
+    """
+    Delete the files and directories under path, deepest first
+
+    Returns the number of files deleted, it stops early if quit is set.
+    """
+    files = []
+    dirs = []
+    for root, dirnames, filenames in os.walk(path, topdown=False):
+        files += [os.path.join(root, f) for f in filenames]
+        # Symlinks to directories are listed in dirnames but are removed like files
+        for d in dirnames:
+            d = os.path.join(root, d)
+            (files if os.path.islink(d) else dirs).append(d)
+    dirs.append(path)
+
+    log.info("Deleting", path=path, files=len(files), directories=len(dirs))
+    start = time.monotonic()
+    reported = start
+    deleted = 0
+    for f in files:
+        if quit.is_set():
+            return deleted
+        limit.wait()
+        try:
+            os.unlink(f)
+            deleted += 1
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            log.error("Failed to delete", path=f, exception=str(e))
+
+        if time.monotonic() - reported >= PROGRESS_INTERVAL:
+            reported = time.monotonic()
+            log.info("Delete progress", path=path, deleted=deleted, remaining=len(files) - deleted,
+                     rate=round(deleted / (reported - start), 1))
+
+    for d in dirs:
+        try:
+            os.rmdir(d)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            log.error("Failed to delete directory", path=d, exception=str(e))
+
+    log.info("Deleted", path=path, files=deleted, duration=round(time.monotonic() - start, 3))
+    return deleted
+
+
+def delete_worker(logging_queue, base_dir, quit, rate=200):
+    """
+    Delete everything moved into base_dir/delete_queue/, at most rate files per second
+
+    The delete_queue directory is the list of work, anything left in it when
+    strix is stopped is deleted after it is restarted. This runs at idle
+    priority so that deleting old events doesn't hold up motion writing new
+    images.
+    """
+    log = logger.log(logging_queue)
+    delete_queue = os.path.abspath(os.path.join(base_dir, "delete_queue"))
+    os.makedirs(delete_queue, exist_ok=True)
+    set_idle_priority(log)
+    log.info("Started delete worker", delete_queue=delete_queue, rate=rate)
+
+    try:
+        watcher = InotifyWatcher(delete_queue, IN_CREATE|IN_MOVED_TO)
+    except OSError as e:
+        log.info("inotify is not available, polling the delete_queue", exception=str(e))
+        watcher = None
+
+    limit = RateLimit(rate)
+    # Paths that could not be deleted, {name: (time of the next try, seconds to wait after that)}
+    failed = {}
+    while not quit.is_set():
+        # Anything in delete_queue/ is deleted, including the leftovers from a previous run
+        names = sorted(os.listdir(delete_queue))
+        failed = {name: retry for name, retry in failed.items() if name in names}
+        for name in names:
+            if quit.is_set():
+                break
+            if name in failed and time.monotonic() < failed[name][0]:
+                continue
+            path = os.path.join(delete_queue, name)
+            try:
+                if name.startswith(STAGING_PREFIX) and time.time() - os.lstat(path).st_mtime < STAGING_MAX_AGE:
+                    continue
+            except FileNotFoundError:
+                continue
+            if os.path.isdir(path) and not os.path.islink(path):
+                delete_tree(log, path, limit, quit)
+            else:
+                try:
+                    os.unlink(path)
+                except OSError as e:
+                    log.error("Failed to delete", path=path, exception=str(e))
+
+            # Back off on paths that cannot be removed instead of trying them every POLL_INTERVAL
+            if not quit.is_set() and os.path.lexists(path):
+                delay = failed[name][1] if name in failed else RETRY_MIN
+                failed[name] = (time.monotonic() + delay, min(delay * 2, RETRY_MAX))
+                log.error("Failed to delete everything, trying again later", path=path, retry=delay)
+
+        if watcher:
+            watcher.wait(POLL_INTERVAL)
+        else:
+            quit.wait(POLL_INTERVAL)
+
+    if watcher:
+        watcher.close()
+    log.info("delete worker is quitting")
@@ -0,0 +1,176 @@
+# eventdb.py
+#
+# Copyright (C) 2017 Brian C. Lane
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from contextlib import contextmanager
+import json
+import os
+import sqlite3
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    event_path  TEXT PRIMARY KEY,
+    day_path    TEXT NOT NULL,
+    details     TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_day ON events (day_path);
+CREATE TABLE IF NOT EXISTS days (
+    day_path    TEXT PRIMARY KEY,
+    mtime_ns    INTEGER NOT NULL
+);
+"""
+
+class EventDBClass:
+    """
+    Optional SQLite index of the event details
+
+    This holds the same details as the per-event .details.json files so that
+    the cache can be loaded with one query at startup. Each day directory's
+    mtime is recorded after it has been reconciled with the filesystem, days
+    that have not changed since then do not need to be scanned again.
+    """
+    def __init__(self):
+        self._path = None
+        self._pid = None
+        self._conn = None
+        self._deferred = False
+        self._lock = threading.Lock()
+
+    def open(self, path):
+        with self._lock:
+            self._path = path
+            self._connect()
+
+    def enabled(self):
+        return self._path is not None
+
+    def close(self):
+        """
+        Close the connection, it is opened again when it is next used
+
+        SQLite connections must not be carried across a fork, call this before
+        starting the processes that use the EventDB.
+        """
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.close()
+            self._conn = None
+
+    def _connect(self):
+        """
+        Return the connection, reopening it in a new process after a fork
+
+        Must be called with the lock held
+        """
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self._path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(SCHEMA)
+            self._pid = os.getpid()
+        return self._conn
+
+    def _commit(self, conn):
+        if not self._deferred:
+            conn.commit()
+
+    @contextmanager
+    def deferred(self):
+        """
+        Batch all of the writes made inside the context into one commit
+        """
+        with self._lock:
+            self._deferred = True
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._deferred = False
+                if self._path:
+                    self._connect().commit()
+
+    def load(self):
+        """
+        Return a dict of all the indexed events, grouped by day directory
+
+        eg. {day_path: {event_path: details, ...}, ...}
+        """
+        if not self._path:
+            return {}
+
+        with self._lock:
+            rows = self._connect().execute("SELECT day_path, event_path, details FROM events").fetchall()
+
+        days = {}
+        for day_path, event_path, details in rows:
+            days.setdefault(day_path, {})[event_path] = json.loads(details)
+        return days
+
+    def put(self, event_path, details):
+        if not self._path:
+            return
+
+        day_path = os.path.dirname(event_path.rstrip("/"))
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT OR REPLACE INTO events VALUES (?, ?, ?)",
+                         (event_path, day_path, json.dumps(details, default=str)))
+            self._commit(conn)
+
+    def remove(self, event_paths):
+        if not self._path:
+            return
+
+        with self._lock:
+            conn = self._connect()
+            conn.executemany("DELETE FROM events WHERE event_path=?", ((p,) for p in event_paths))
+            self._commit(conn)
+
+    def day_mtimes(self):
+        """
+        Return a dict of the day directories and their mtime_ns when they were last reconciled
+
+        eg. {day_path: mtime_ns, ...}
+        """
+        if not self._path:
+            return {}
+
+        with self._lock:
+            return dict(self._connect().execute("SELECT day_path, mtime_ns FROM days").fetchall())
+
+    def set_day_mtime(self, day_path, mtime_ns):
+        if not self._path:
+            return
+
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT OR REPLACE INTO days VALUES (?, ?)", (day_path, mtime_ns))
+            self._commit(conn)
+
+    def remove_days(self, day_paths):
+        if not self._path:
+            return
+
+        with self._lock:
+            conn = self._connect()
+            for day_path in day_paths:
+                conn.execute("DELETE FROM events WHERE day_path=?", (day_path,))
+                conn.execute("DELETE FROM days WHERE day_path=?", (day_path,))
+            self._commit(conn)
+
+
+# Singleton
+EventDB = EventDBClass()
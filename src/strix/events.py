@@ -14,53 +14,242 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import base64
+from bisect import bisect_left, bisect_right, insort
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from glob import glob
+import heapq
+from itertools import chain, islice
 import json
 import multiprocessing as mp
+import multiprocessing.connection
 import os
 from pathlib import Path
 import re
 import shutil
+import sys
 import tempfile
 import threading
+import time
+from types import MappingProxyType
 
 import structlog
 
+from .deleter import STAGING_PREFIX
+from .eventdb import EventDB
+from .metrics import Metrics
+from .queue import BestThumbnail
+from .thumbnail import is_thumbnail, make_thumbnails
+
+class EventRecord:
+    """
+    Compact form of an event's details dict, as stored in the EventCache
+
+    The path components are interned so that they are shared by all of the
+    events for a camera and day, the times are stored as integer timestamps,
+    and the URLs are only built when details() is called. The media fields
+    are stored as a filename relative to the event's URL, or as the full
+    string if it contains a / (eg. images/missing.jpg)
+    """
+    __slots__ = ("prefix", "camera", "day", "time", "start_ts", "end_ts",
+                 "video", "debug_video", "thumbnail", "saved")
+
+    def __init__(self, event_path, details):
+        prefix, camera, day, time = event_path.rsplit("/", 3)
+        self.prefix = sys.intern(prefix)
+        self.camera = sys.intern(camera)
+        self.day = sys.intern(day)
+        self.time = sys.intern(time)
+        self.start_ts = int(details["start"].timestamp())
+        self.end_ts = int(details["end"].timestamp())
+
+        url = self.url + "/"
+        def media(value):
+            if value.startswith(url) and "/" not in value[len(url):]:
+                return sys.intern(value[len(url):])
+            return sys.intern(value)
+        self.video = media(details["video"])
+        self.debug_video = media(details["debug_video"])
+        self.thumbnail = media(details["thumbnail"])
+        self.saved = bool(details["saved"])
+
+    def __eq__(self, other):
+        if not isinstance(other, EventRecord):
+            return NotImplemented
+        return all(getattr(self, a) == getattr(other, a) for a in self.__slots__)
+
+    @property
+    def event_path(self):
+        return "/".join([self.prefix, self.camera, self.day, self.time])
+
+    @property
+    def url(self):
+        return "motion/" + "/".join([self.camera, self.day, self.time])
+
+    @property
+    def start(self):
+        return datetime.fromtimestamp(self.start_ts)
+
+    def _media_url(self, value):
+        if "/" in value:
+            return value
+        return self.url + "/" + value
+
+    def details(self):
+        """
+        Return the event's details dict, in the same form event_details() built it
+        """
+        start = self.start
+        return {
+            "start":        start,
+            "end":          datetime.fromtimestamp(self.end_ts),
+            "title":        start.strftime("%a %b %d %I:%M:%S %p"),
+            "video":        self._media_url(self.video),
+            "debug_video":  self._media_url(self.debug_video),
+            "thumbnail":    self._media_url(self.thumbnail),
+            "images":       [],
+            "saved":        self.saved,
+            "event_path":   self.event_path,
+        }
+
+
+def event_camera(event_path):
+    """
+    Return the camera name from an event path, eg. /base/Camera1/2026-10-17/01-00-00
+    """
+    parts = event_path.rsplit("/", 3)
+    if len(parts) < 4:
+        raise KeyError(event_path)
+    return parts[1]
+
+
+class EventSnapshot:
+    """
+    Immutable view of the cached events at one point in time
+
+    The EventCache publishes a new snapshot after each change, readers use
+    the current one without taking the lock. Each camera's events and index
+    are only copied when that camera's events change, the rest are shared
+    with the previous snapshot.
+    """
+    __slots__ = ("records", "index", "generation", "modified", "camera_generation")
+
+    def __init__(self, records, index, generation, modified, camera_generation):
+        # {camera: {event_path: EventRecord}}
+        self.records = records
+        # {camera: ((start, event_path), ...)} sorted oldest to newest
+        self.index = index
+        self.generation = generation
+        self.modified = modified
+        self.camera_generation = camera_generation
+
+    def get(self, key):
+        return self.records.get(event_camera(key), {})[key].details()
+
+    def events(self, camera=None, reverse=False):
+        """
+        Return a sorted list of the events
+        """
+        if not camera:
+            return sorted(chain.from_iterable(self.records.values()), reverse=reverse)
+
+        # limit results to the selected camera
+        paths = [p for _, p in self.index.get(camera, ())]
+        if reverse:
+            paths.reverse()
+        return paths
+
+    def camera_range(self, camera, start, end, offset=0, limit=0, before=None):
+        """
+        Return the event paths for a camera with start <= event time <= end
+
+        The list is ordered newest to oldest, skipping the newest offset events
+        and returning at most limit of them (0 returns all of them).
+        before is a (time, event_path) key from parse_cursor(), only events
+        older than it are returned.
+        """
+        index = self.index.get(camera, ())
+        lo = bisect_left(index, (start, ""))
+        hi = bisect_right(index, (end, "\U0010ffff"))
+        if before is not None:
+            hi = min(hi, bisect_left(index, before))
+        hi -= max(0, offset)
+        if limit > 0:
+            lo = max(lo, hi - limit)
+        if hi <= lo:
+            return []
+        return [p for _, p in reversed(index[lo:hi])]
+
+    def _range_keys(self, camera, start, end, before):
+        """
+        Yield the (time, event_path) keys for a camera, newest to oldest, without copying the index
+        """
+        index = self.index.get(camera, ())
+        lo = bisect_left(index, (start, ""))
+        hi = bisect_right(index, (end, "\U0010ffff"))
+        if before is not None:
+            hi = min(hi, bisect_left(index, before))
+        for i in range(hi - 1, lo - 1, -1):
+            yield index[i]
+
+    def timeline(self, cameras, start, end, offset=0, limit=0, before=None):
+        """
+        Return the event paths for several cameras merged into one list, newest to oldest
+
+        The cameras' indexes are merged lazily so that only the events up to
+        offset + limit are looked at. offset, limit and before work the same
+        way as camera_range() but apply to the merged list.
+        """
+        offset = max(0, offset)
+        merged = heapq.merge(*(self._range_keys(camera, start, end, before) for camera in cameras),
+                             reverse=True)
+        return [p for _, p in islice(merged, offset, offset + limit if limit > 0 else None)]
+
+    def version(self, camera=None):
+        """
+        Return a (generation, modified) tuple that changes whenever the events change
+
+        If camera is passed it only changes when that camera's events change.
+        """
+        if camera:
+            return self.camera_generation.get(camera, (0, self.modified))
+        return (self.generation, self.modified)
+
+
 class EventCacheClass:
     def __init__(self):
         self._log = None
         self._base_dir = "/invalid/path/for/expire"
-        self._last_check = datetime.now()
         self._check_cache = 60
         self._keep_days = 9999
+        # Serializes the writers, readers use the published snapshot
         self._lock = threading.Lock()
-        self._cache = {}
-
-    def cleanup_dq(self):
+        # Per-camera dicts of {event_path: EventRecord}
+        self._records = {}
+        # Per-camera lists of (start, event_path) tuples, sorted oldest to newest
+        self._index = {}
+        # Bumped every time the cached events change, and when it happened
+        self._generation = 0
+        self._modified = datetime.now()
+        # The same for each camera's events
+        self._camera_generation = {}
+        # Cameras changed since the last snapshot was published
+        self._dirty = set()
+        self._deferred = False
+        self._snapshot = EventSnapshot(MappingProxyType({}), MappingProxyType({}),
+                                       self._generation, self._modified, MappingProxyType({}))
+
+    def snapshot(self):
         """
-        Cleanup any delete_queue subdirectories that may be leftover from previous run
-        """
-
-        def dth_fn(dq_dirs):
-            for dq in dq_dirs:
-                if not dq.startswith(self._base_dir):
-                    raise RuntimeError(f"Invalid dq path: {dq}")
+        Return the current EventSnapshot
 
-                shutil.rmtree(dq, ignore_errors=True)
-
-        base = os.path.join(self._base_dir, "delete_queue")
-        dq_dirs = [os.path.join(base, dq) for dq in os.listdir(base)]
-
-        # Start a thread to do the actual delete in the background
-        dth = mp.Process(name="delete-thread",
-                            target=dth_fn,
-                            args=(dq_dirs,))
-        dth.start()
+        Use this to make several queries against the same version of the events.
+        """
+        return self._snapshot
 
     def get(self, key):
-        with self._lock:
-            return self._cache[key]
+        return self._snapshot.get(key)
 
     def set(self, key, value):
         with self._lock:
@@ -70,28 +259,89 @@ class EventCacheClass:
             if "end" in value and type(value["end"]) == type(""):
                 value["end"] = datetime.fromisoformat(value["end"])
 
-            # Add missing title (old cache will not have this new field)
-            if "title" not in value:
-                value["title"] = value["start"].strftime("%a %b %d %I:%M:%S %p"),
+            # The title is built from the start time (old cache will not have this field)
+            record = EventRecord(key, value)
+            records = self._records.setdefault(record.camera, {})
 
-            self._cache[key] = value
+            if key not in records:
+                self._index_add(key, record)
+            if records.get(key) != record:
+                records[key] = record
+                self._changed(record.camera)
+                self._publish()
 
-            # This can potentially remove the key just added if it is an old event
-            self._expire_events()
+            # Old events are removed by the expire thread, see start_expire()
+            return True
 
-            # Return True if it was added to the cache
-            return key in self._cache
+    @contextmanager
+    def deferred(self):
+        """
+        Publish all of the changes made inside the context as one snapshot
+        """
+        with self._lock:
+            self._deferred = True
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._deferred = False
+                self._publish()
+
+    def _publish(self):
+        """
+        Replace the snapshot with one that includes the changed cameras
+
+        Must be called with the lock held
+        """
+        if self._deferred or not self._dirty:
+            return
+
+        records = dict(self._snapshot.records)
+        index = dict(self._snapshot.index)
+        for camera in self._dirty:
+            records[camera] = MappingProxyType(dict(self._records[camera]))
+            index[camera] = tuple(self._index[camera])
+        self._dirty.clear()
+
+        self._snapshot = EventSnapshot(MappingProxyType(records), MappingProxyType(index),
+                                       self._generation, self._modified,
+                                       MappingProxyType(dict(self._camera_generation)))
 
     def events(self, camera=None, reverse=False):
+        return self._snapshot.events(camera, reverse)
+
+    def camera_range(self, camera, start, end, offset=0, limit=0, before=None):
+        return self._snapshot.camera_range(camera, start, end, offset, limit, before)
+
+    def timeline(self, cameras, start, end, offset=0, limit=0, before=None):
+        return self._snapshot.timeline(cameras, start, end, offset, limit, before)
+
+    def _index_add(self, key, record):
         """
-        Return a sorted list of the events
+        Add an event to its camera's time ordered index
+
+        Must be called with the lock held
         """
-        if not camera:
-            return sorted(self._cache.keys(), reverse=reverse)
+        insort(self._index.setdefault(record.camera, []), (event_dt(key, {"start": record.start}), key))
 
-        cp = self._base_dir + "/" + camera
-        # limit results to the selected camera
-        return sorted((p for p in self._cache.keys() if p.startswith(cp)), reverse=reverse)
+    def generation(self, camera=None):
+        """
+        Return a (generation, modified) tuple that changes whenever the events change
+
+        If camera is passed it only changes when that camera's events change.
+        """
+        return self._snapshot.version(camera)
+
+    def _changed(self, camera):
+        """
+        Record a change to the cached events of a camera
+
+        Must be called with the lock held
+        """
+        self._generation += 1
+        self._modified = datetime.now()
+        self._camera_generation[camera] = (self._generation, self._modified)
+        self._dirty.add(camera)
 
     def base_dir(self, base_dir):
         with self._lock:
@@ -109,10 +359,6 @@ class EventCacheClass:
         with self._lock:
             self._check_cache = minutes
 
-    def reset_check(self):
-        with self._lock:
-            self._last_check = datetime(1985, 10, 26, 1, 22, 0)
-
     def log_info(self, *args):
         if self._log:
             self._log.info(*args)
@@ -121,113 +367,297 @@ class EventCacheClass:
         if self._log:
             self._log.error(*args)
 
-    def _expire_events(self):
-        start = datetime.now()
+    def start_expire(self, run=None):
+        """
+        Start a thread that calls expire_events() every check_cache minutes
 
-        if start - self._last_check < timedelta(minutes=self._check_cache):
-            return
-        self._last_check = datetime.now()
+        The first check is made right away. run is passed to expire_events().
+        """
+        def expire_fn():
+            while True:
+                try:
+                    self.expire_events(run)
+                except Exception as e:
+                    self.log_error(f"Expiring events failed: {e}")
+                time.sleep(self._check_cache * 60)
+
+        th = threading.Thread(name="expire-thread", target=expire_fn, daemon=True)
+        th.start()
+        return th
+
+    def expire_events(self, run=None):
+        """
+        Remove events older than keep days from the cache and move them to the delete_queue
+
+        The per-camera indexes are in time order, so only the expired events are
+        looked at. The lock is only held while they are removed from the cache,
+        the directories are moved afterwards by move_expired(). When all of a
+        day's events have expired the whole day directory is moved with one rename.
+
+        If run is passed the moves are done with run(move_expired, args), eg.
+        gevent's threadpool.apply so that they don't block the other greenlets.
+        """
+        start = datetime.now()
+        cutoff = start - timedelta(days=self._keep_days)
 
         self.log_info("Checking cache...")
 
         remove = {}
-        for e in self._cache:
-            if self._cache[e]["start"] < datetime.now() - timedelta(days=self._keep_days):
-                if "event_path" in self._cache[e] \
-                   and self._cache[e]["event_path"].startswith(self._base_dir):
-                    daypath = os.path.dirname(self._cache[e]["event_path"].rstrip("/"))
-                    if daypath in remove:
-                        remove[daypath].append(e)
-                    else:
-                        remove[daypath] = [e]
+        whole_days = set()
+        expired_count = 0
+        with self._lock:
+            for camera, index in self._index.items():
+                n = bisect_left(index, (cutoff, ""))
+                if n == 0:
+                    continue
+
+                expired = [e for _, e in index[:n]]
+                del index[:n]
+                expired_count += n
+                for e in expired:
+                    record = self._records[camera].pop(e)
+                    if record.event_path.startswith(self._base_dir):
+                        daypath = os.path.dirname(record.event_path.rstrip("/"))
+                        remove.setdefault(daypath, []).append(e)
+
+                # Days that still have events in the next day's worth of the index are partial
+                expired_days = set(os.path.dirname(e.rstrip("/")) for e in expired)
+                for _, e in index[:bisect_left(index, (cutoff + timedelta(days=1), ""))]:
+                    expired_days.discard(os.path.dirname(e.rstrip("/")))
+                whole_days.update(expired_days)
+                self._changed(camera)
+            self._publish()
 
         self.log_info(f"Done checking cache in {datetime.now()-start}")
+        Metrics.inc("strix_event_cache_expired_total", expired_count)
 
         if len(remove) == 0:
+            Metrics.observe("strix_event_cache_expire_seconds", (datetime.now()-start).total_seconds())
             return
 
-        # The result of the above is a dict (remove) with daily lists of events to be
-        # removed. NOTE that this may not be ALL the day's events so it needs to move
-        # them individually, but needs to use the Camera and date to prevent collisions
-        # with other cameras while waiting for the delete to run in the background.
+        if run:
+            messages = run(self.move_expired, (remove, whole_days))
+        else:
+            messages = self.move_expired(remove, whole_days)
+        for log_fn, msg in messages:
+            log_fn(msg)
+
+        self.log_info(f"Expire of {len(remove)} directories took: {datetime.now()-start}")
+        Metrics.observe("strix_event_cache_expire_seconds", (datetime.now()-start).total_seconds())
 
-        # Create the temporary delete_queue directory
-        delete_queue = tempfile.mkdtemp(dir=os.path.join(self._base_dir, "delete_queue"))
+    def move_expired(self, remove, whole_days):
+        """
+        Move the expired events to the delete_queue and remove them from the EventDB
+
+        remove is a dict of {daypath: [event_path, ...]} and the days in
+        whole_days are moved with one rename. Nothing is logged so that this is
+        safe to run on a native thread, the messages are returned as a list of
+        (log function, message) for the caller to log.
+        """
+        messages = []
+
+        # remove has the daily lists of events to be removed. Days in whole_days have no
+        # events left so the day directory is moved, otherwise they are moved individually.
+        # Either way it needs to use the Camera and date to prevent collisions with other
+        # cameras while waiting for the delete to run in the background.
+
+        # Create the temporary delete_queue directory, it is hidden from the delete worker until it is filled
+        staging = tempfile.mkdtemp(prefix=STAGING_PREFIX, dir=os.path.join(self._base_dir, "delete_queue"))
 
         # Move each day's directory to the temporary delete_queue directory
         for daypath in remove:
             # All paths should have a Camera* component
-            cm = re.search("(Camera\d+)", daypath)
+            cm = re.search(r"(Camera\d+)", daypath)
             if not cm:
-                self.log_error(f"Camera* missing from path {daypath}")
+                messages.append((self.log_error, f"Camera* missing from path {daypath}"))
 
             if cm and os.path.exists(daypath):
-                # Make a directory for the day's events
                 daydir = os.path.basename(daypath)
-                dqdir = os.path.join(delete_queue, cm.group(), daydir)
-                if not os.path.exists(dqdir):
-                    os.makedirs(dqdir)
+                if daypath in whole_days:
+                    # Move the whole day into the delete_queue/Camera*/ directory
+                    dqdir = os.path.join(staging, cm.group())
+                    os.makedirs(dqdir, exist_ok=True)
+                    messages.append((self.log_info, f"MOVE: {daypath} -> {dqdir}"))
+                    os.rename(daypath, os.path.join(dqdir, daydir))
+                else:
+                    # Make a directory for the day's events
+                    dqdir = os.path.join(staging, cm.group(), daydir)
+                    os.makedirs(dqdir, exist_ok=True)
+
+                    # Move the expired events into the delete_queue/Camera*/YYYY-MM-DD/ directory
+                    for e in remove[daypath]:
+                        messages.append((self.log_info, f"MOVE: {e} -> {dqdir}"))
+                        shutil.move(e, dqdir)
+
+            messages.append((self.log_info, f"Removed {len(remove[daypath])} events from {daypath}"))
+            EventDB.remove(remove[daypath])
+        EventDB.remove_days(whole_days)
+
+        # Hand it to the delete worker
+        os.rename(staging, os.path.join(os.path.dirname(staging), os.path.basename(staging)[len(STAGING_PREFIX):]))
+        return messages
 
-                # Move the expired events into the delete_queue/Camera*/YYYY-MM-DD/ directory
-                for e in remove[daypath]:
-                    self.log_info(f"MOVE: {e} -> {dqdir}")
-                    shutil.move(e, dqdir)
 
-            # Remove the events from the cache
-            self.log_info(f"Removing {len(remove[daypath])} events from {daypath}")
-            for e in remove[daypath]:
-                del self._cache[e]
+# Singleton
+EventCache = EventCacheClass()
 
-        self.log_info(f"Expire of {len(remove)} directories took: {datetime.now()-start}")
 
-        def dth_fn(delete_queue):
-            shutil.rmtree(delete_queue, ignore_errors=True)
+def scan_day(log, day_path, indexed, backfill=False):
+    """
+    Scan a YYYY-MM-DD directory for its events
 
-        # Start a thread to do the actual delete in the background
-        dth = mp.Process(name="delete-thread",
-                            target=dth_fn,
-                            args=(delete_queue,))
-        dth.start()
+    indexed is a set of the event paths already in the EventDB, their details
+    are not read. This doesn't touch the EventCache so that it can be run in a
+    preload worker process, the results are added to the cache by load_day()
+    backfill is passed to read_event_details()
 
+    Returns a tuple of (all event paths, [(event_path, details), ...], unprocessed dirs, elapsed)
+    """
+    start = datetime.now()
 
-# Singleton
-EventCache = EventCacheClass()
+    # HH-MM-SS is the format of the event directories.
+    all_day_events = sorted(glob(day_path + "/??-??-??"), reverse=True)
+    loaded = [(event_path, read_event_details(log, event_path, backfill))
+              for event_path in all_day_events if event_path not in indexed]
 
+    # Check for unprocessed directories that don't fit the pattern
+    # These are likely events that were never processed due to a restart
+    all_dirs = sorted(glob(day_path + "/*"), reverse=True)
+    diff_dirs = sorted(set(all_dirs) - set(all_day_events))
 
-def preload_cache(log, base_dir):
-    log.info("Pre-loading event cache...")
+    return (all_day_events, loaded, diff_dirs, datetime.now()-start)
 
-    total = timedelta()
-    for camera in sorted(c for c in os.listdir(base_dir) if c.startswith("Camera")):
-        start = datetime.now()
 
-        # YYYY-MM-DD/HH-MM-SS is the format of the event directories.
-        glob_path="%s/%s/????-??-??/??-??-??" % (base_dir, camera)
-        all_camera_events = sorted(glob(glob_path), reverse=True)
-        for event_path in all_camera_events:
-            _ = event_details(log, event_path)
-        log.info(f"{camera} event cache loaded in {datetime.now()-start} seconds")
-        total += datetime.now()-start
+def _scan_days_worker(log, tasks, tx, backfill):
+    for day_path, indexed in tasks:
+        tx.send((day_path, scan_day(log, day_path, indexed, backfill)))
+    tx.close()
+
 
-        # Check for unprocessed directories that don't fit the pattern
-        # These are likely events that were never processed due to a restart
-        glob_all_path="%s/%s/????-??-??/*" % (base_dir, camera)
-        all_dirs = sorted(glob(glob_all_path), reverse=True)
-        diff_dirs = set(all_dirs) - set(all_camera_events)
+def load_day(log, base_dir, day_path, mtime_ns, indexed, scanned):
+    """
+    Add the results from scan_day() to the EventCache and EventDB
+
+    Any unprocessed event directories are added back to the queue.
+    """
+    all_day_events, loaded, diff_dirs, _ = scanned
 
-        # Write new queue entries for these unprocessed directories
-        # /strix/media/queue/Camera%t_%Y-%m-%d_%v
-        # Remove the base dir, Replace the / with _, and touch a file
-        for d in diff_dirs:
-            event = d.removeprefix(base_dir).lstrip("/").replace("/", "_")
-            td = Path(os.path.join(base_dir, "queue", event))
-            log.debug(f"Recreating unprocessed event - {td}")
-            td.touch()
+    for event_path in all_day_events:
+        if event_path in indexed:
+            EventCache.set(event_path, indexed[event_path])
+    for event_path, details in loaded:
+        if EventCache.set(event_path, details):
+            EventDB.put(event_path, details)
 
-    log.info(f"Event cache loaded in {total} seconds")
+    # Drop indexed events that are no longer on disk
+    EventDB.remove(set(indexed) - set(all_day_events))
 
-    # Next event will check for expired entries
-    EventCache.reset_check()
+    # Write new queue entries for these unprocessed directories
+    # /strix/media/queue/Camera%t_%Y-%m-%d_%v
+    # Remove the base dir, Replace the / with _, and touch a file
+    for d in diff_dirs:
+        event = d.removeprefix(base_dir).lstrip("/").replace("/", "_")
+        td = Path(os.path.join(base_dir, "queue", event))
+        log.debug(f"Recreating unprocessed event - {td}")
+        td.touch()
+
+    # Unprocessed days need to be scanned again next time
+    if not diff_dirs:
+        EventDB.set_day_mtime(day_path, mtime_ns)
+
+
+def preload_cache(log, base_dir, jobs=1, backfill=False):
+    """
+    Load all of the events into the EventCache
+
+    When the EventDB is enabled day directories that haven't changed since
+    they were last reconciled are loaded from it without being scanned. The
+    rest are scanned by a pool of jobs processes when jobs > 1.
+
+    backfill creates the missing thumbnails for old events. Every day is
+    scanned when it is set, the EventDB is updated with the new details.
+    """
+    log.info("Pre-loading event cache...")
+
+    start = datetime.now()
+    indexed = EventDB.load() if not backfill else {}
+    reconciled = EventDB.day_mtimes() if not backfill else {}
+    if EventDB.enabled():
+        log.info(f"Event index loaded in {datetime.now()-start} seconds")
+
+    # YYYY-MM-DD is the format of the day directories.
+    cameras = sorted(c for c in os.listdir(base_dir) if c.startswith("Camera"))
+
+    # Split the days into ones that can be loaded from the index and ones to scan
+    unchanged = []
+    to_scan = []
+    mtimes = {}
+    for camera in cameras:
+        for day_path in sorted(glob("%s/%s/????-??-??" % (base_dir, camera)), reverse=True):
+            mtimes[day_path] = os.stat(day_path).st_mtime_ns
+            if indexed.get(day_path) and reconciled.get(day_path) == mtimes[day_path]:
+                unchanged.append(day_path)
+            else:
+                to_scan.append(day_path)
+
+    def scan_results():
+        tasks = [(d, set(indexed.get(d, {}))) for d in to_scan]
+        if jobs <= 1 or len(tasks) <= 1:
+            for day_path, day_indexed in tasks:
+                yield (day_path, scan_day(log, day_path, day_indexed, backfill))
+            return
+
+        # mp.Pool's helper threads don't work with gevent's monkey patching,
+        # so start the workers directly and read their results from Pipes
+        workers = []
+        readers = []
+        for i in range(min(jobs, len(tasks))):
+            rx, tx = mp.Pipe(False)
+            worker = mp.Process(name=f"preload-{i}",
+                                target=_scan_days_worker,
+                                args=(log, tasks[i::jobs], tx, backfill))
+            worker.start()
+            tx.close()
+            workers.append(worker)
+            readers.append(rx)
+
+        while readers:
+            for rx in mp.connection.wait(readers):
+                try:
+                    yield rx.recv()
+                except EOFError:
+                    readers.remove(rx)
+
+        for worker in workers:
+            worker.join()
+
+    # Per-camera time spent scanning, and the number of days left to finish it
+    elapsed = {camera: timedelta() for camera in cameras}
+    remaining = {camera: 0 for camera in cameras}
+    for day_path in to_scan:
+        remaining[day_path.rsplit("/", 2)[-2]] += 1
+
+    with EventCache.deferred():
+        for day_path in unchanged:
+            for event_path, details in indexed.pop(day_path).items():
+                EventCache.set(event_path, details)
+        for camera in (c for c in cameras if remaining[c] == 0):
+            log.info(f"{camera} event cache loaded from index")
+
+        with EventDB.deferred():
+            for day_path, scanned in scan_results():
+                camera = day_path.rsplit("/", 2)[-2]
+                load_day(log, base_dir, day_path, mtimes[day_path], indexed.pop(day_path, {}), scanned)
+                elapsed[camera] += scanned[-1]
+                remaining[camera] -= 1
+                if remaining[camera] == 0:
+                    log.info(f"{camera} event cache loaded in {elapsed[camera]} seconds")
+
+    # Anything left in the index is from a day directory that has been removed
+    EventDB.remove_days(indexed.keys())
+
+    log.info(f"Event cache loaded in {datetime.now()-start} seconds")
+    Metrics.set("strix_preload_seconds", (datetime.now()-start).total_seconds())
 
 
 def path_to_dt(path):
@@ -237,6 +667,40 @@ def path_to_dt(path):
     dt_str = "{0} {1}".format(date, time)
     return datetime.strptime(dt_str, "%Y-%m-%d %H:%M:%S")
 
+def event_dt(path, details):
+    """ Return the time used to order an event
+
+    This is the time from the event's path, falling back to its start time
+    if the path doesn't end with YYYY-MM-DD/HH-MM-SS
+    """
+    try:
+        return path_to_dt(path)
+    except ValueError:
+        return details["start"]
+
+def make_cursor(event_path, details):
+    """
+    Return an opaque cursor for resuming a camera_events() listing after this event
+    """
+    key = json.dumps([event_dt(event_path, details).isoformat(), event_path])
+    return base64.urlsafe_b64encode(key.encode("utf-8")).decode("ascii")
+
+def parse_cursor(cursor):
+    """
+    Return the (time, event_path) key from a make_cursor() cursor
+
+    Raises ValueError if it is not a valid cursor
+    """
+    try:
+        dt, event_path = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        dt = datetime.fromisoformat(dt)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+    # The cached events have naive times and paths of /base/camera/date/event
+    if dt.tzinfo is not None or not isinstance(event_path, str) or event_path.count("/") < 3:
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return (dt, event_path)
+
 def image_to_dt(event_date, image):
     """ Convert an event date (YYYY-MM-DD) and image HH-MM-SS-FF
 
@@ -247,25 +711,25 @@ def image_to_dt(event_date, image):
     return datetime.strptime(event_date+"/"+image_time, "%Y-%m-%d/%H-%M-%S")
 
 
-def event_details(log, event_path):
-    # Check the cache for the details
-    try:
-        return EventCache.get(event_path)
-    except KeyError:
-        pass
+def read_event_details(log, event_path, backfill=False):
+    """
+    Return the details of an event without using the EventCache
+
+    They are read from the event's .details.json, or built from the contents
+    of the directory and written to .details.json if it is missing. This is
+    safe to call from a preload worker process.
 
-    # Try the file cache next
+    When backfill is True events without a thumbnail.jpg have their thumbnails
+    created from the image with the most changes, and the details are rebuilt.
+    """
     try:
         if os.path.exists(event_path+"/.details.json"):
             with open(event_path+"/.details.json") as f:
                 details = json.load(f)
-
-            # Adding to the cache can potentially expire old events
-            ok = EventCache.set(event_path, details)
-            if ok:
+            # Old events may be using one of their full size images as the thumbnail
+            thumbnail = details.get("thumbnail", "")
+            if not backfill or not thumbnail.startswith("motion/") or thumbnail.endswith("/thumbnail.jpg"):
                 return details
-            else:
-                return None
     except json.decoder.JSONDecodeError:
         log.error("Error reading .details.json from %s", event_path)
 
@@ -274,13 +738,23 @@ def event_details(log, event_path):
     # Grab the camera, date, and time and build the URL path
     url = "motion/"+"/".join([camera_name, event_date, event_time])
 
-    # Get the list of images, skipping thumbnail.jpg
+    # Get the list of images, skipping the thumbnails
     images = []
     for i in sorted(glob(event_path+"/*.jpg")):
-        if "thumbnail.jpg" in i:
+        if is_thumbnail(i):
             continue
         images.append(os.path.basename(i))
 
+    if backfill and images and not os.path.exists(event_path+"/thumbnail.jpg"):
+        try:
+            try:
+                best = BestThumbnail(event_path)
+            except IndexError:
+                best = os.path.join(event_path, images[len(images)//4])
+            make_thumbnails(best, event_path)
+        except Exception as e:
+            log.error("Failed to create thumbnail for %s: %s", event_path, e)
+
     if os.path.exists(event_path+"/thumbnail.jpg"):
         thumbnail = url+"/thumbnail.jpg"
     elif images:
@@ -321,43 +795,56 @@ def event_details(log, event_path):
         "event_path":   event_path,
     }
 
-    # Adding to the cache can potentially expire it if it was an old event
+    with open(event_path+"/.details.json", "w") as f:
+        json.dump(details, f, default=str)
+    return details
+
+
+def event_details(log, event_path):
+    # Check the cache for the details
+    try:
+        details = EventCache.get(event_path)
+        Metrics.inc("strix_event_cache_requests_total", result="hit")
+        return details
+    except KeyError:
+        Metrics.inc("strix_event_cache_requests_total", result="miss")
+
+    details = read_event_details(log, event_path)
+
     ok = EventCache.set(event_path, details)
     if not ok:
         return None
 
-    with open(event_path+"/.details.json", "w") as f:
-        json.dump(details, f, default=str)
+    EventDB.put(event_path, details)
     return details
 
 
-def camera_events(log, base_dir, camera, start, end, offset, limit):
-    # Newest to oldest, limited by offset and limit
-    skipped = 0
-    added = 0
+def camera_events(log, base_dir, camera, start, end, offset, limit, before=None):
+    # Newest to oldest, limited by offset and limit, and older than the before cursor key
     events = []
-    for event_path in EventCache.events(camera=camera, reverse=True):
-        dt = path_to_dt(event_path)
-        if dt < start or dt > end:
-            continue
-        if skipped < offset:
-            skipped += 1
-            continue
-
+    for event_path in EventCache.camera_range(camera, start, end, offset, limit, before):
         details = event_details(log, event_path)
         if details is not None:
             events.insert(0, details)
 
-        added += 1
-        if limit > 0 and added >= limit:
-            break
+    return events
+
+def timeline_events(log, base_dir, cameras, start, end, offset, limit, before=None):
+    # The events for all of the cameras, oldest to newest, with offset and limit applied to the merged list
+    events = []
+    for event_path in EventCache.timeline(cameras, start, end, offset, limit, before):
+        details = event_details(log, event_path)
+        if details is not None:
+            events.insert(0, details)
 
     return events
 
-def queue_events(log, queue_rx):
+def queue_events(log, queue_rx, notify=None):
     """
     Loop, reading new event paths from the Pipe (the queue mp thread is at the other end)
     and adding their details to the EventCache
+
+    notify is called with the event_path and details of each new event once it is cached
     """
     while True:
         try:
@@ -368,4 +855,6 @@ def queue_events(log, queue_rx):
         except EOFError:
             break
 
-        _ = event_details(log, event_path)
+        details = event_details(log, event_path)
+        if notify and details is not None:
+            notify(event_path, details)
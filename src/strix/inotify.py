@@ -0,0 +1,105 @@
+# inotify.py
+#
+# Copyright (C) 2017 Brian C. Lane
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+
+# From /usr/include/linux/inotify.h
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_Q_OVERFLOW  = 0x00004000
+IN_NONBLOCK    = 0o4000
+IN_CLOEXEC     = 0o2000000
+
+# struct inotify_event is followed by len bytes of name
+EVENT_HEADER = struct.Struct("iIII")
+
+class InotifyWatcher:
+    """
+    Watch a directory for new files using the Linux inotify API
+
+    Only the standard C library is needed, it is accessed with ctypes.
+    Raises OSError if inotify isn't available.
+    """
+    def __init__(self, path, mask=IN_CREATE|IN_CLOSE_WRITE|IN_MOVED_TO|IN_ATTRIB):
+        libc_name = ctypes.util.find_library("c")
+        if not libc_name:
+            raise OSError("Cannot find the C library")
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify is not supported")
+
+        self._fd = libc.inotify_init1(IN_NONBLOCK|IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        wd = libc.inotify_add_watch(self._fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(errno, f"inotify_add_watch failed for {path}")
+
+    def fileno(self):
+        return self._fd
+
+    def wait(self, timeout):
+        """
+        Wait up to timeout seconds for files to change
+
+        Returns the same as read(), the list is empty on a timeout
+        """
+        r, _, _ = select.select([self._fd], [], [], timeout)
+        if not r:
+            return ([], False)
+        return self.read()
+
+    def read(self):
+        """
+        Read the pending events without blocking
+
+        Returns a tuple of the list of names that changed and True if the
+        kernel's event queue overflowed, in which case some changes were lost
+        and the directory needs to be scanned.
+        """
+        names = []
+        overflow = False
+        while True:
+            try:
+                buf = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            if not buf:
+                break
+
+            i = 0
+            while i < len(buf):
+                _wd, mask, _cookie, length = EVENT_HEADER.unpack_from(buf, i)
+                i += EVENT_HEADER.size
+                name = buf[i:i+length].rstrip(b"\0")
+                i += length
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                elif name:
+                    names.append(os.fsdecode(name))
+        return (names, overflow)
+
+    def close(self):
+        os.close(self._fd)
@@ -14,9 +14,16 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from datetime import datetime, timezone
+import json
 import logging
 from logging.handlers import RotatingFileHandler, QueueHandler
 import multiprocessing as mp
+import multiprocessing.util
+import os
+from queue import Empty, Full
+from threading import Thread
+import time
 
 import structlog
 
@@ -39,29 +46,200 @@ structlog.configure(
     cache_logger_on_first_use=True,
 )
 
+# Records are sent to the listener in batches of up to LOG_BATCH_SIZE records,
+# or after LOG_FLUSH_INTERVAL seconds
+LOG_BATCH_SIZE = 100
+LOG_FLUSH_INTERVAL = 0.5
+
+# Most batches written by the listener before it flushes the file
+LOG_DRAIN_MAX = 100
+
+# Records held by a process while the queue is full, the oldest are dropped after this
+LOG_BUFFER_MAX = 10 * LOG_BATCH_SIZE
+
+# 1 in LOG_DEBUG_SAMPLE debug records are kept by the "sample" policy
+LOG_DEBUG_SAMPLE = 10
+
+# What happens to debug records while the queue is full, set by configure()
+_debug_policy = "sample"
+
+def configure(debug_policy):
+    """
+    Set the policy for debug records when the log queue is full
+
+    "keep" holds them like the other records, "sample" keeps 1 in LOG_DEBUG_SAMPLE
+    and "drop" drops them. This must be called before starting the processes.
+    """
+    global _debug_policy
+    _debug_policy = debug_policy
+
+
+class BatchQueueHandler(QueueHandler):
+    """
+    QueueHandler that sends lists of records and never blocks
+
+    The queue is bounded. When it is full the records are kept until it has
+    room, the oldest are dropped if too many are waiting, and the debug
+    records are handled according to the debug policy. The number of
+    dropped records is logged when there is room again.
+    """
+    def __init__(self, queue, debug_policy="sample"):
+        super().__init__(queue)
+        self._debug_policy = debug_policy
+        self._buffer = []
+        self._full = False
+        self._dropped = 0
+        self._debug_count = 0
+        self._pid = None
+
+    def _after_fork(self):
+        """
+        Start the flush thread in a new process
+
+        The records buffered by the parent are left for it to send.
+        """
+        self._pid = os.getpid()
+        self._buffer = []
+        self._full = False
+        self._dropped = 0
+        Thread(target=self._flush_fn, daemon=True).start()
+        # Send what is left when the process exits, waiting a little for room in the queue.
+        # This has to run before the queue's own finalizer (exitpriority 10) closes it.
+        mp.util.Finalize(self, self.flush, kwargs={"timeout": LOG_FLUSH_INTERVAL}, exitpriority=20)
+
+    def _flush_fn(self):
+        while True:
+            time.sleep(LOG_FLUSH_INTERVAL)
+            self.flush()
+
+    def _keep_debug(self):
+        if self._debug_policy == "keep":
+            return True
+        if self._debug_policy == "sample":
+            self._debug_count += 1
+            return self._debug_count % LOG_DEBUG_SAMPLE == 0
+        return False
+
+    def emit(self, record):
+        try:
+            if self._pid != os.getpid():
+                self._after_fork()
+
+            if self._full and record.levelno <= logging.DEBUG and not self._keep_debug():
+                self._dropped += 1
+                return
+
+            self._buffer.append(self.prepare(record))
+            if len(self._buffer) >= LOG_BATCH_SIZE:
+                self._send()
+        except Exception:
+            self.handleError(record)
+
+    def _send(self, timeout=None):
+        """
+        Put the buffered records on the queue, waiting up to timeout seconds if it is full
+
+        Must be called with the handler lock held
+        """
+        if self._dropped and not self._full:
+            self._buffer.append(self._dropped_record())
+
+        try:
+            self.queue.put(self._buffer, timeout is not None, timeout)
+            self._buffer = []
+            self._full = False
+        except Full:
+            self._full = True
+            # Keep the newest records
+            if len(self._buffer) > LOG_BUFFER_MAX:
+                self._dropped += len(self._buffer) - LOG_BUFFER_MAX
+                del self._buffer[:-LOG_BUFFER_MAX]
+
+    def _dropped_record(self):
+        dropped = self._dropped
+        self._dropped = 0
+        msg = json.dumps({"event": f"Dropped {dropped} log records, the log queue was full",
+                          "dropped": dropped, "level": "warning",
+                          "timestamp": datetime.now(timezone.utc).isoformat()})
+        return logging.makeLogRecord({"msg": msg, "levelno": logging.WARNING, "levelname": "WARNING"})
+
+    def flush(self, timeout=None):
+        with self.lock:
+            if self._buffer or self._dropped:
+                self._send(timeout)
+
+
+class BatchFileHandler(RotatingFileHandler):
+    """
+    RotatingFileHandler that leaves the writes in the file's buffer until flush()
+
+    The size of the file is tracked instead of seeking to the end of it for
+    every record.
+    """
+    def __init__(self, filename, maxBytes=0, backupCount=0):
+        super().__init__(filename, maxBytes=maxBytes, backupCount=backupCount)
+        self._size = self.stream.tell()
+
+    def emit(self, record):
+        try:
+            msg = self.format(record) + self.terminator
+            if self.maxBytes > 0 and self._size > 0 and self._size + len(msg) >= self.maxBytes:
+                self.doRollover()
+                self._size = 0
+            self.stream.write(msg)
+            self._size += len(msg)
+        except Exception:
+            self.handleError(record)
+
+
 def listener(queue, stop_event, log_path):
-    handler = RotatingFileHandler(log_path, maxBytes=100*1024**2, backupCount=10)
+    handler = BatchFileHandler(log_path, maxBytes=100*1024**2, backupCount=10)
     formatter = logging.Formatter('%(message)s')
     handler.setFormatter(formatter)
     logger = logging.getLogger("logger-listener")
     logger.addHandler(handler)
 
+    def write(batches):
+        running = True
+        for batch in batches:
+            if batch is None: # We send this as a sentinel to tell the listener to quit.
+                running = False
+                continue
+            for record in batch:
+                logger.handle(record) # No level or filter logic applied - just do it!
+        handler.flush()
+        return running
+
+    def drain(batches):
+        while len(batches) < LOG_DRAIN_MAX:
+            try:
+                batches.append(queue.get_nowait())
+            except Empty:
+                break
+        return batches
+
     # XXX QueueListener doesn't work for me, do it manually
-    while not stop_event.is_set():
+    # Each wakeup writes all of the batches that are waiting, and then flushes the file
+    running = True
+    while running and not stop_event.is_set():
         try:
-            record = queue.get()
-            if record is None: # We send this as a sentinel to tell the listener to quit.
-                break
-            logger.handle(record) # No level or filter logic applied - just do it!
-            queue.task_done()
+            try:
+                batches = [queue.get(timeout=1)]
+            except Empty:
+                continue
+            running = write(drain(batches))
         except (KeyboardInterrupt, SystemExit):
             raise
         except:
             import sys, traceback
             traceback.print_exc(file=sys.stderr)
 
+    # Write what was sent before being told to quit
+    if running:
+        write(drain([]))
+
 def log(queue):
-    handler = QueueHandler(queue)
+    handler = BatchQueueHandler(queue, _debug_policy)
     root = structlog.get_logger()
     root.addHandler(handler)
     root.setLevel(logging.DEBUG)
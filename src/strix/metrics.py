@@ -0,0 +1,231 @@
+# metrics.py
+#
+# Copyright (C) 2017 Brian C. Lane
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from bisect import bisect_left
+from contextlib import contextmanager
+import threading
+import time
+
+# Histogram buckets, in seconds
+FAST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SLOW_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+# The metrics that can be recorded, name: (type, help, histogram buckets)
+METRICS = {
+    "strix_queue_depth":                ("gauge", "Events waiting in the job queue", None),
+    "strix_queue_in_flight":            ("gauge", "Events being processed by the queue workers", None),
+    "strix_queue_threads":              ("gauge", "ffmpeg threads given to the events being processed", None),
+    "strix_queue_events_total":         ("counter", "Events handed to the queue workers", None),
+    "strix_queue_wait_seconds":         ("histogram", "Time from motion queuing an event to it being processed",
+                                         SLOW_BUCKETS),
+    "strix_queue_worker_restarts_total":("counter", "Queue workers restarted after dying", None),
+    "strix_process_event_seconds":      ("histogram", "Time spent in each stage of process_event", SLOW_BUCKETS),
+    "strix_process_event_total":        ("counter", "Events processed, by result", None),
+    "strix_ffmpeg_failures_total":      ("counter", "ffmpeg runs that failed to start or exited with an error",
+                                         None),
+    "strix_event_cache_events":         ("gauge", "Events in the EventCache", None),
+    "strix_event_cache_requests_total": ("counter", "EventCache lookups by event_details, by result", None),
+    "strix_event_cache_expire_seconds": ("histogram", "Time taken to expire old events", FAST_BUCKETS),
+    "strix_event_cache_expired_total":  ("counter", "Events removed from the EventCache by expiry", None),
+    "strix_preload_seconds":            ("gauge", "Time taken to preload the EventCache at startup", None),
+    "strix_http_requests_total":        ("counter", "HTTP requests, by route, method and status", None),
+    "strix_http_request_seconds":       ("histogram", "Time taken to handle HTTP requests, by route", FAST_BUCKETS),
+}
+
+def _labels(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ""
+
+    def escape(v):
+        return v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class MetricsClass:
+    """
+    Counters, gauges and histograms, rendered in the Prometheus text format
+
+    Each process records into its own copy. The queue workers send what they
+    have recorded to monitor_queue after each event, and it sends its totals
+    on to the API process, which adds them to its own when rendering.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # {(name, labels): value} for the counters and gauges
+        self._values = {}
+        # {(name, labels): [bucket counts, ..., +Inf count, sum, count]}
+        self._histograms = {}
+        # The latest totals from other processes, {source: collect()}
+        self._sources = {}
+        self._changed = False
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+            self._changed = True
+
+    def set(self, name, value, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self._values[key] = value
+            self._changed = True
+
+    def observe(self, name, value, **labels):
+        buckets = METRICS[name][2]
+        key = (name, _labels(labels))
+        with self._lock:
+            h = self._histograms.get(key)
+            if h is None:
+                h = self._histograms[key] = [0] * (len(buckets) + 3)
+            h[bisect_left(buckets, value)] += 1
+            h[-2] += value
+            h[-1] += 1
+            self._changed = True
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Observe the time taken by the body of the with statement
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def changed(self):
+        """
+        Return True if anything has been recorded since the last collect()
+        """
+        return self._changed
+
+    def collect(self, reset=False):
+        """
+        Return a copy of the recorded metrics that can be sent to another process
+
+        reset clears them, so that the next collect() only has the new values.
+        """
+        with self._lock:
+            snapshot = {
+                "values": dict(self._values),
+                "histograms": {k: list(v) for k, v in self._histograms.items()},
+            }
+            self._changed = False
+            if reset:
+                self._values = {}
+                self._histograms = {}
+        return snapshot
+
+    def merge(self, snapshot):
+        """
+        Add the metrics from another process's collect(reset=True) to these
+        """
+        with self._lock:
+            self._merge(self._values, self._histograms, snapshot)
+            self._changed = True
+
+    @staticmethod
+    def _merge(values, histograms, snapshot):
+        for key, value in snapshot["values"].items():
+            if METRICS[key[0]][0] == "gauge":
+                values[key] = value
+            else:
+                values[key] = values.get(key, 0) + value
+        for key, h in snapshot["histograms"].items():
+            if key in histograms:
+                histograms[key] = [a + b for a, b in zip(histograms[key], h)]
+            else:
+                histograms[key] = list(h)
+
+    def set_source(self, source, snapshot):
+        """
+        Replace the totals from another process with its latest collect()
+        """
+        with self._lock:
+            self._sources[source] = snapshot
+
+    def reset(self):
+        """
+        Clear everything, used by new processes so they don't report their parent's metrics
+        """
+        with self._lock:
+            self._values = {}
+            self._histograms = {}
+            self._sources = {}
+            self._changed = False
+
+    def render(self):
+        """
+        Return this process's metrics and the other sources in the text exposition format
+        """
+        values = {}
+        histograms = {}
+        with self._lock:
+            for snapshot in [{"values": self._values, "histograms": self._histograms}] + list(self._sources.values()):
+                self._merge(values, histograms, snapshot)
+
+        lines = []
+        for name, (kind, help_text, buckets) in METRICS.items():
+            samples = sorted((k, v) for k, v in values.items() if k[0] == name)
+            series = sorted((k, v) for k, v in histograms.items() if k[0] == name)
+            if not samples and not series:
+                continue
+
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (_, labels), value in samples:
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+            for (_, labels), h in series:
+                cumulative = 0
+                for le, n in zip(list(buckets) + [float("inf")], h):
+                    cumulative += n
+                    lines.append(f"{name}_bucket{_format_labels(labels, [('le', _format_value(float(le)))])} "
+                                 f"{cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(h[-2])}")
+                lines.append(f"{name}_count{_format_labels(labels)} {h[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+def receive_metrics(metrics_rx, source):
+    """
+    Loop, reading the totals sent by another process and storing them as source
+    """
+    while True:
+        try:
+            if not metrics_rx.poll(10):
+                continue
+
+            Metrics.set_source(source, metrics_rx.recv())
+        except EOFError:
+            break
+
+
+# Singleton
+Metrics = MetricsClass()
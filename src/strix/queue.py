@@ -14,39 +14,156 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from datetime import datetime, timedelta
 from glob import glob
+import heapq
 import json
 import multiprocessing as mp
+import multiprocessing.connection
 import os
+import resource
 import shutil
+import struct
 import subprocess
 import time
 
-from PIL import Image
+from gevent.threadpool import ThreadPoolExecutor
 import structlog
 
 from . import logger
+from .inotify import InotifyWatcher
+from .metrics import Metrics
+from .thumbnail import make_sprites, make_thumbnails
 
-THUMBNAIL_SIZE = (640, 480)
+# EXIF tag holding motion's <changed>-<noise>-<width>-<height>-<X>-<Y>
+EXIF_IMAGE_DESCRIPTION = 0x010e
 
 # More than 5 minute events have a timelapse created
 TIMELAPSE_MIN = 5 * 60 * 5
 
+# Timelapse videos play 16x faster, using 1/16th of the frames
+TIMELAPSE_SPEED = 16
+
+# Directory of links to the frames used for the timelapse
+TIMELAPSE_DIR = ".timelapse"
+
+# Segments of in-progress events are encoded into this directory, as
+# [debug-]<full|timelapse>-<first image>-<end image>.m4v
+SEGMENT_DIR = ".segments"
+
+# Images in each segment, timelapse segments use every TIMELAPSE_SPEED'th image from this many
+SEGMENT_FRAMES = 150
+
+# Seconds between looking for new segments to encode
+SEGMENT_CHECK = 5
+
+# Events that haven't had a new image for this many seconds are not segmented
+SEGMENT_IDLE = 10 * 60
+
+# Seconds to wait before encoding a segment again after it failed, doubling each time
+SEGMENT_RETRY_MIN = 30
+SEGMENT_RETRY_MAX = SEGMENT_IDLE
+
+# Frames encoded per ffmpeg thread, shorter events are not given more threads than they can use
+FRAMES_PER_THREAD = 50
+
+# The video encoder options used when none are passed to process_event()
+VIDEO_ARGS = ["-c:v", "h264", "-b:v", "2M"]
+
 def max_cores() -> int:
     return max(1, mp.cpu_count() // 2)
 
 
-def GetImageDescriptions(path):
+def video_args(codec="h264", bitrate="2M", preset=None):
+    """
+    Return the ffmpeg output options for the videos
+    """
+    args = ["-c:v", codec, "-b:v", bitrate]
+    if preset:
+        args += ["-preset", preset]
+    return args
+
+
+def ReadImageDescription(filename):
+    """
+    Read the EXIF ImageDescription from a JPEG without decoding it
+
+    Only the headers up to the APP1 Exif segment are read from the file.
+    Returns None if there is no ImageDescription.
+    """
+    with open(filename, "rb") as f:
+        if f.read(2) != b"\xff\xd8":
+            return None
+
+        while True:
+            header = f.read(4)
+            if len(header) < 4 or header[0] != 0xff:
+                return None
+            marker = header[1]
+            length = struct.unpack(">H", header[2:])[0]
+
+            # Stop at the start of the image data or the first non-APPn segment
+            if marker == 0xda or not 0xe0 <= marker <= 0xef:
+                return None
+            if marker != 0xe1:
+                f.seek(length - 2, os.SEEK_CUR)
+                continue
+
+            segment = f.read(length - 2)
+            if segment[:6] == b"Exif\0\0":
+                break
+
+    # The Exif segment is a TIFF header followed by IFD0
+    tiff = segment[6:]
+    try:
+        endian = {b"II": "<", b"MM": ">"}[tiff[:2]]
+        ifd0 = struct.unpack_from(endian + "I", tiff, 4)[0]
+        count = struct.unpack_from(endian + "H", tiff, ifd0)[0]
+        for i in range(count):
+            tag, typ, n, value = struct.unpack_from(endian + "HHII", tiff, ifd0 + 2 + i * 12)
+            if tag != EXIF_IMAGE_DESCRIPTION or typ != 2:
+                continue
+            if n <= 4:
+                data = tiff[ifd0 + 2 + i * 12 + 8:ifd0 + 2 + i * 12 + 8 + n]
+            else:
+                data = tiff[value:value + n]
+            return data.rstrip(b"\0").decode("utf-8", errors="replace")
+    except (KeyError, struct.error):
+        pass
+
+    return None
+
+
+def GetImageDescriptions(path, jobs=4):
     """
     Extract EXIF ImageDescription for all the images in the directory
+
+    The headers are read in-process using jobs native threads, threading is
+    monkey-patched by gevent and its threads would read them one at a time.
+    If none of the images have a description exiftool is used instead.
     """
+    files = sorted(glob(os.path.join(path, "*.jpg")))
+
+    def read(filename):
+        try:
+            return ReadImageDescription(filename)
+        except OSError:
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        descriptions = list(executor.map(read, files))
+
+    data = [{"SourceFile": f, "ImageDescription": d} for f, d in zip(files, descriptions) if d is not None]
+    if data or not files:
+        return data
+
     ## Run exiftool on the files
     cmd = ["exiftool", "-json", "-q", "-ImageDescription", path]
     try:
         out = subprocess.check_output(cmd)
         j = json.loads(out)
         return [d for d in j if "ImageDescription" in d]
-    except subprocess.CalledProcessError:
+    except (subprocess.CalledProcessError, OSError):
         pass
 
     return []
@@ -81,13 +198,15 @@ def DescriptionDict(desc):
         }
 
 
-def BestThumbnail(path):
+def BestThumbnail(path, data=None):
     """
     Make a best guess at the image to use for a thumbnail
 
-    Use the one with the most changes.
+    Use the one with the most changes. data is the output of
+    GetImageDescriptions(path), if it has already been read.
     """
-    data = GetImageDescriptions(path)
+    if data is None:
+        data = GetImageDescriptions(path)
 
     images = []
     for i in data:
@@ -96,15 +215,323 @@ def BestThumbnail(path):
     return sorted_images[0]["name"]
 
 
-## Handle watching the queue and dispatching movie creation and directory moving
+def TimelapseFrames(images, changed=None, speed=TIMELAPSE_SPEED):
+    """
+    Pick the indexes of the images to use for a timelapse
+
+    Without changed every speed'th image is used. changed is a dict of image
+    name to its EXIF changed value, when it is passed the same number of images
+    are picked but they are spaced closer together where there is more motion.
+    """
+    count = max(1, len(images) // speed)
+    values = [changed.get(name, 0) for name in images] if changed else []
+    moving = [v for v in values if v > 0]
+    if not moving:
+        return list(range(0, len(images), speed))[:count]
+
+    # Images with motion are weighted by their change relative to the average,
+    # still images are used 4x less often than an average moving one.
+    mean = sum(moving) / len(moving)
+    weights = [v / mean if v > 0 else 0.25 for v in values]
+    step = sum(weights) / count
+
+    frames = []
+    total = 0
+    next_frame = 0
+    for i, w in enumerate(weights):
+        if total >= next_frame and len(frames) < count:
+            frames.append(i)
+            next_frame += step
+        total += w
+    return frames
+
+
+def MakeTimelapseDir(path, images, frames):
+    """
+    Link the selected frames into path/TIMELAPSE_DIR/ as a numbered sequence
+
+    Frames past the end of images are skipped
+    """
+    timelapse_path = os.path.join(path, TIMELAPSE_DIR)
+    os.mkdir(timelapse_path)
+    for n, i in enumerate(f for f in frames if f < len(images)):
+        os.symlink(os.path.join("..", images[i]), os.path.join(timelapse_path, "%06d.jpg" % n))
+
+
+def run_ffmpeg(log, jobs, concurrent=True):
+    """
+    Run ffmpeg jobs concurrently and wait for all of them to finish
+
+    jobs is a list of (name, cmd, cwd) tuples, when concurrent is False they
+    are run one after the other.
+    Returns True if all of them succeeded
+    """
+    ok = True
+    procs = []
+    for name, cmd, cwd in jobs:
+        try:
+            procs.append((name, subprocess.Popen(cmd, cwd=cwd, stdin=subprocess.DEVNULL)))
+        except Exception as e:
+            log.error(f"Failed to create {name}", exception=str(e))
+            Metrics.inc("strix_ffmpeg_failures_total")
+            ok = False
+        if not concurrent:
+            ok = wait_ffmpeg(log, procs) and ok
+            procs = []
+
+    return wait_ffmpeg(log, procs) and ok
+
+
+def wait_ffmpeg(log, procs):
+    """
+    Wait for the (name, Popen) ffmpeg processes, returns True if all of them succeeded
+    """
+    ok = True
+    for name, proc in procs:
+        if proc.wait() != 0:
+            log.error(f"Failed to create {name}", returncode=proc.returncode)
+            Metrics.inc("strix_ffmpeg_failures_total")
+            ok = False
+    return ok
+
+
+def concurrent_encodes(threads):
+    """
+    Return True if the video and debug video are encoded at the same time
+
+    With only 1 thread for the event they are encoded one after the other,
+    0 is not limited.
+    """
+    return threads != 1
+
+
+def ffmpeg_command(inputs, output, threads=0, video=None):
+    """
+    Return the ffmpeg command to encode images into a video
+
+    inputs are the ffmpeg input options, threads is the total for the video
+    and debug video encodes. They are split between them when they run at
+    the same time, see concurrent_encodes().
+    """
+    cmd = ["ffmpeg", "-f", "image2", "-framerate", "5"] + inputs + ["-vf", "scale=1280:-2"]
+    if threads > 0:
+        cmd += ["-threads", str(threads // 2 if concurrent_encodes(threads) else threads)]
+    return cmd + (video or VIDEO_ARGS) + [output]
+
+
+def event_images(event_path):
+    """
+    Return sorted lists of the images and debug images in an event's directory
+    """
+    images = []
+    debug_images = []
+    with os.scandir(event_path) as it:
+        for e in it:
+            if e.name.endswith("m.jpg"):
+                debug_images.append(e.name)
+            elif e.name.endswith(".jpg"):
+                images.append(e.name)
+    return sorted(images), sorted(debug_images)
+
+
+def segment_kind(images, timelapse):
+    """
+    Return the kind of video an event with this many images is made into, and its image step
+
+    Returns None for a timelapse that cannot be built from segments, the
+    motion weighted frames depend on the whole event.
+    """
+    if images <= TIMELAPSE_MIN:
+        return ("full", 1)
+    if timelapse == "nth":
+        return ("timelapse", TIMELAPSE_SPEED)
+    return None
+
+
+def encoded_segments(segment_path, kind):
+    """
+    Return the names of the segments of a kind that cover the event from its first image
+
+    Also returns the index of the first image that isn't in them.
+    """
+    ranges = []
+    try:
+        for name in os.listdir(segment_path):
+            if name.startswith(kind + "-") and name.endswith(".m4v") and \
+               os.path.exists(os.path.join(segment_path, "debug-" + name)):
+                _, start, end = name[:-4].split("-")
+                ranges.append((int(start), int(end), name))
+    except (OSError, ValueError):
+        return [], 0
+
+    names = []
+    covered = 0
+    for start, end, name in sorted(ranges):
+        if start != covered:
+            break
+        names.append(name)
+        covered = end
+    return names, covered
+
+
+def next_segment(event_path, timelapse):
+    """
+    Return the (kind, start, end) image range of the next segment to encode for an in-progress event
+
+    The newest image is left out, motion may still be writing it. Returns
+    None if there isn't a whole segment waiting to be encoded.
+    """
+    images, debug_images = event_images(event_path)
+    complete = min(len(images), len(debug_images)) - 1
+    kind = segment_kind(complete, timelapse)
+    if kind is None:
+        return None
+
+    _, covered = encoded_segments(os.path.join(event_path, SEGMENT_DIR), kind[0])
+    end = covered + SEGMENT_FRAMES * kind[1]
+    if end > complete:
+        return None
+    return (kind[0], covered, end)
+
+
+def encode_segment(log, event_path, debug_path, images, debug_images, kind, start, end, threads=0, video=None):
+    """
+    Encode the images from start to end, and the matching debug images, into a segment
+
+    The segment is only renamed to its final name when both encodes
+    succeed, what is left of a failed one is removed. Returns True if it was
+    encoded.
+    """
+    step = TIMELAPSE_SPEED if kind == "timelapse" else 1
+    segment_path = os.path.join(event_path, SEGMENT_DIR)
+    name = f"{kind}-{start:06d}-{end:06d}.m4v"
+    os.makedirs(segment_path, exist_ok=True)
+
+    jobs = []
+    for prefix, path, names in [("", event_path, images), ("debug-", debug_path, debug_images)]:
+        # Link the frames into a numbered sequence, the same way as the timelapse
+        frames_path = os.path.join(segment_path, prefix + name[:-4])
+        shutil.rmtree(frames_path, ignore_errors=True)
+        os.mkdir(frames_path)
+        for n, i in enumerate(range(start, min(end, len(names)), step)):
+            os.symlink(os.path.abspath(os.path.join(path, names[i])), os.path.join(frames_path, "%06d.jpg" % n))
+        # ffmpeg won't overwrite a partial encode left by a worker that died or a restart
+        try:
+            os.unlink(os.path.join(segment_path, f".{prefix}{name}"))
+        except FileNotFoundError:
+            pass
+        cmd = ffmpeg_command(["-i", os.path.join(frames_path, "%06d.jpg")], f".{prefix}{name}", threads, video)
+        jobs.append((f"{prefix}{kind} segment", cmd, segment_path))
+
+    ok = run_ffmpeg(log, jobs, concurrent_encodes(threads))
+    for prefix in ["", "debug-"]:
+        shutil.rmtree(os.path.join(segment_path, prefix + name[:-4]), ignore_errors=True)
+        if ok:
+            os.rename(os.path.join(segment_path, f".{prefix}{name}"), os.path.join(segment_path, prefix + name))
+        else:
+            try:
+                os.unlink(os.path.join(segment_path, f".{prefix}{name}"))
+            except FileNotFoundError:
+                pass
+    return ok
+
+
+def process_segment(log, base_dir, event, segment, threads=0, video=None):
+    """
+    Encode the next segment of an in-progress event
+
+    segment is the (kind, start, end) from next_segment()
+
+    Returns True if it was encoded
+    """
+    event_path = os.path.join(base_dir, event.replace("_", os.path.sep))
+    images, debug_images = event_images(event_path)
+    kind, start, end = segment
+    with Metrics.timer("strix_process_event_seconds", stage="segment"):
+        ok = encode_segment(log, event_path, event_path, images, debug_images, kind, start, end, threads, video)
+    log.info("Encoded segment", queue_event=event, kind=kind, start=start, end=end, threads=threads, ok=ok)
+    return ok
+
+
+def encode_from_segments(log, event_path, debug_path, images, debug_images, timelapse, threads=0, video=None):
+    """
+    Make the videos from the segments encoded while the event was in progress
+
+    Only the images after the last segment are encoded, then the segments
+    are joined without encoding them again. Returns False if the videos
+    need to be made from all of the images instead.
+    """
+    kind = segment_kind(len(images), timelapse)
+    if kind is None:
+        return False
+    segment_path = os.path.join(event_path, SEGMENT_DIR)
+    names, covered = encoded_segments(segment_path, kind[0])
+    if not names:
+        return False
+
+    if covered < len(images) or covered < len(debug_images):
+        end = max(len(images), len(debug_images))
+        if not encode_segment(log, event_path, debug_path, images, debug_images,
+                              kind[0], covered, end, threads, video):
+            return False
+        names.append(f"{kind[0]}-{covered:06d}-{end:06d}.m4v")
+
+    jobs = []
+    for prefix, output in [("", os.path.join(event_path, "video.m4v")),
+                           ("debug-", os.path.join(debug_path, "video.m4v"))]:
+        with open(os.path.join(segment_path, prefix + "segments.txt"), "w") as f:
+            for name in names:
+                f.write(f"file '{prefix}{name}'\n")
+        jobs.append((f"{prefix}video", ["ffmpeg", "-f", "concat", "-safe", "0", "-i", prefix + "segments.txt",
+                                        "-c", "copy", "-y", output], segment_path))
+    log.info("Joining segments", event_path=event_path, segments=len(names), kind=kind[0])
+    return run_ffmpeg(log, jobs)
+
+
+def in_progress_events(base_dir):
+    """
+    Return the queue style names of the events that motion is recording
+
+    These are the Camera*/YYYY-MM-DD/<event number>/ directories from today
+    and yesterday that have changed in the last SEGMENT_IDLE seconds.
+    """
+    now = datetime.now()
+    days = [now.strftime("%Y-%m-%d"), (now - timedelta(days=1)).strftime("%Y-%m-%d")]
+    cutoff = time.time() - SEGMENT_IDLE
+    events = []
+    for camera_path in glob(os.path.join(base_dir, "Camera*")):
+        camera = os.path.basename(camera_path)
+        for day in days:
+            try:
+                with os.scandir(os.path.join(camera_path, day)) as it:
+                    for e in it:
+                        if e.name.isdigit() and e.is_dir() and e.stat().st_mtime > cutoff:
+                            events.append(f"{camera}_{day}_{e.name}")
+            except OSError:
+                pass
+    return events
+
+
+def process_event(log: structlog.BoundLogger, base_dir: str, event: str, queue_tx,
+                  threads: int = 0, timelapse: str = "nth", video: list = None) -> None:
+    """
+    Make the videos and thumbnail for an event and move it to its final location
 
-def process_event(log: structlog.BoundLogger, base_dir: str, event: str, queue_tx) -> None:
+    threads is the number of cpu threads the event may use, 0 lets ffmpeg decide.
+    timelapse selects how frames are picked for long events, "nth" or "motion".
+    video is the ffmpeg encoder options from video_args(), defaults to VIDEO_ARGS.
+    The duration and the cpu time used by the child processes are logged when done.
+    """
     log.info(event_path=event, base_dir=base_dir)
+    start = time.monotonic()
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start_cpu = usage.ru_utime + usage.ru_stime
 
     # The actual path is the event with _ replaced by /
     event_path = os.path.join(base_dir, event.replace("_", os.path.sep))
     if not os.path.isdir(event_path):
         log.error("event_path doesn't exist", event_path=event_path)
+        Metrics.inc("strix_process_event_total", result="missing")
         return
 
     debug_path = os.path.join(event_path, "debug")
@@ -112,6 +539,7 @@ def process_event(log: structlog.BoundLogger, base_dir: str, event: str, queue_t
         os.mkdir(debug_path, mode=0o755)
     except Exception as e:
         log.error("Failed to create debug directory", exception=str(e))
+        Metrics.inc("strix_process_event_total", result="error")
         return
 
     # Move the debug images into ./debug/
@@ -121,39 +549,69 @@ def process_event(log: structlog.BoundLogger, base_dir: str, event: str, queue_t
     except Exception as e:
         log.debug("Failed to move debug images into ./debug/")
 
-    ffmpeg_cmd = ["ffmpeg", "-f", "image2", "-pattern_type", "glob", "-framerate", "5",
-            "-i", "*.jpg", "-vf", "scale=1280:-2"]
+    images = sorted(os.path.basename(f) for f in glob(os.path.join(event_path, "*.jpg")))
+    with Metrics.timer("strix_process_event_seconds", stage="descriptions"):
+        descriptions = GetImageDescriptions(event_path)
 
-    # Make a timelapse for events that are too long
-    if len(glob(f"{event_path}/*jpg")) > TIMELAPSE_MIN:
-        ffmpeg_cmd += ["-vf", "setpts=0.0625*PTS"]
+    # Use the segments encoded while the event was in progress, if there are any
+    ffmpeg_start = time.monotonic()
+    encoded = False
+    if os.path.isdir(os.path.join(event_path, SEGMENT_DIR)):
+        debug_images = sorted(os.path.basename(f) for f in glob(os.path.join(debug_path, "*.jpg")))
+        encoded = encode_from_segments(log, event_path, debug_path, images, debug_images, timelapse, threads, video)
+        if not encoded:
+            log.info("Encoding all of the images instead of using the segments", event_path=event_path)
 
-    ffmpeg_cmd += ["-c:v", "h264", "-b:v", "2M", "video.m4v"]
-    log.debug("ffmpeg cmdline", ffmpeg_cmd=ffmpeg_cmd)
+    if not encoded:
+        # Make a timelapse for events that are too long, only the frames it uses are encoded
+        if len(images) > TIMELAPSE_MIN:
+            changed = None
+            if timelapse == "motion":
+                changed = {os.path.basename(d["SourceFile"]): DescriptionDict(d["ImageDescription"])["changed"]
+                           for d in descriptions}
+            with Metrics.timer("strix_process_event_seconds", stage="timelapse"):
+                frames = TimelapseFrames(images, changed)
+                debug_images = sorted(os.path.basename(f) for f in glob(os.path.join(debug_path, "*.jpg")))
+                try:
+                    MakeTimelapseDir(event_path, images, frames)
+                    MakeTimelapseDir(debug_path, debug_images, frames)
+                except Exception as e:
+                    log.error("Failed to create timelapse frames", exception=str(e))
+            log.info("Creating timelapse", frames=len(frames), images=len(images), timelapse=timelapse)
+            inputs = ["-i", os.path.join(TIMELAPSE_DIR, "%06d.jpg")]
+        else:
+            inputs = ["-pattern_type", "glob", "-i", "*.jpg"]
+        ffmpeg_cmd = ffmpeg_command(inputs, "video.m4v", threads, video)
+        log.debug("ffmpeg cmdline", ffmpeg_cmd=ffmpeg_cmd)
 
-    # Make a movie out of the jpg images with ffmpeg
-    try:
-        subprocess.run(ffmpeg_cmd, cwd=event_path, check=True)
-    except Exception as e:
-        log.error("Failed to create video", exception=str(e))
+        # Make movies out of the jpg images and the debug jpg images at the same time
+        ffmpeg_start = time.monotonic()
+        run_ffmpeg(log, [("video", ffmpeg_cmd, event_path),
+                         ("debug video", ffmpeg_cmd, debug_path)], concurrent_encodes(threads))
+    ffmpeg_duration = time.monotonic() - ffmpeg_start
+    Metrics.observe("strix_process_event_seconds", ffmpeg_duration, stage="ffmpeg")
 
-    # Make a movie out of the debug jpg images with ffmpeg
-    try:
-        subprocess.run(ffmpeg_cmd, cwd=debug_path, check=True)
-    except Exception as e:
-        log.error("Failed to create debug video", exception=str(e))
+    for path in [event_path, debug_path]:
+        shutil.rmtree(os.path.join(path, TIMELAPSE_DIR), ignore_errors=True)
+    shutil.rmtree(os.path.join(event_path, SEGMENT_DIR), ignore_errors=True)
 
     try:
         # Get the image with the highest change value
-        thumbnail = BestThumbnail(event_path)
-        im = Image.open(thumbnail)
-        # im.size will get the actual size of the image
-        im.thumbnail(THUMBNAIL_SIZE)
-        im.save(os.path.join(event_path, "thumbnail.jpg"), "JPEG")
+        with Metrics.timer("strix_process_event_seconds", stage="thumbnail"):
+            thumbnail = BestThumbnail(event_path, descriptions)
+            make_thumbnails(thumbnail, event_path)
     except Exception as e:
         log.error("Failed to create thumbnail", exception=str(e))
 
+    try:
+        # Sprite sheets for scrubbing through the event's images
+        with Metrics.timer("strix_process_event_seconds", stage="sprites"):
+            make_sprites(event_path, images)
+    except Exception as e:
+        log.error("Failed to create sprites", exception=str(e))
+
     # Move the directory to its final location
+    result = "ok"
     try:
         # Use the time of the first image
         images = sorted(list(glob(os.path.join(event_path, "*-*-*-*.jpg"))))
@@ -169,33 +627,425 @@ def process_event(log: structlog.BoundLogger, base_dir: str, event: str, queue_t
         queue_tx.send(dest_path)
     except Exception as e:
         log.error("Moving to destination failed", event_path=event_path, exception=str(e))
+        result = "error"
+
+    Metrics.observe("strix_process_event_seconds", time.monotonic() - start, stage="total")
+    Metrics.inc("strix_process_event_total", result=result)
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    log.info("Finished processing event", queue_event=event, threads=threads,
+             duration=round(time.monotonic() - start, 3),
+             ffmpeg_duration=round(ffmpeg_duration, 3),
+             cpu_time=round(usage.ru_utime + usage.ru_stime - start_cpu, 3))
+
+def queued_files(queue_path):
+    """
+    Return a list of (mtime, path) for the files in the queue directory
+    """
+    files = []
+    for event_file in glob(os.path.join(queue_path, "*")):
+        try:
+            files.append((os.path.getmtime(event_file), event_file))
+        except OSError:
+            pass
+    return files
+
+
+def event_frames(base_dir, event):
+    """
+    Return the number of frames that will be encoded for a queued event
+
+    This counts the images in the event's directory, skipping the debug
+    images, and allows for long events being made into a timelapse.
+    """
+    event_path = os.path.join(base_dir, event.replace("_", os.path.sep))
+    try:
+        with os.scandir(event_path) as it:
+            frames = sum(1 for e in it if e.name.endswith(".jpg") and not e.name.endswith("m.jpg"))
+    except OSError:
+        return 0
+    if frames > TIMELAPSE_MIN:
+        frames //= TIMELAPSE_SPEED
+    return frames
+
+
+class ThreadBudget:
+    """
+    Share the cpus between the events being processed
+
+    Each event is given a number of ffmpeg threads when it is started, based
+    on how many cpus are not being used by the other events, how many events
+    are waiting to start, and how many frames it has. New events are held
+    back while the load average shows that the cpus are already busy, unless
+    nothing is being processed.
+
+    threads is the most ffmpeg threads to use for all of the events, the
+    load average is compared with all of the cpus.
+    """
+    def __init__(self, threads=None):
+        self._threads = threads or max_cores()
+        # {event: threads}
+        self._in_use = {}
+
+    def used(self):
+        return sum(self._in_use.values())
+
+    def free(self):
+        return max(0, self._threads - self.used())
+
+    def admit(self):
+        """
+        Return True if another event can be started now
+        """
+        if not self._in_use:
+            return True
+        try:
+            load = os.getloadavg()[0]
+        except OSError:
+            load = 0
+        return self.free() > 0 and load < mp.cpu_count()
+
+    def acquire(self, event, frames, waiting):
+        """
+        Return the number of threads to use for an event and count them as in use
+
+        waiting is the number of events that can be started now, including
+        this one, the free cpus are split between them.
+        """
+        share = max(1, self.free() // max(1, waiting))
+        # Each event runs two encodes, the video and the debug video
+        wanted = 2 * max(1, -(-frames // FRAMES_PER_THREAD))
+        threads = min(share, wanted)
+        self._in_use[event] = threads
+        return threads
 
-def monitor_queue(logging_queue, base_dir, quit, max_threads, queue_tx):
-    threads = []
+    def release(self, event):
+        self._in_use.pop(event, None)
+
+
+class JobQueue:
+    """
+    Bounded priority queue of events waiting to be processed
+
+    order is "fifo" to process them in the order they were pushed, or
+    "oldest" to process the event with the oldest queue file first. motion's
+    event numbers can't be used for this, they are counted per camera and
+    start again when motion is restarted.
+    """
+    def __init__(self, order="fifo", maxsize=1000):
+        self._order = order
+        self._maxsize = maxsize
+        self._heap = []
+        self._events = set()
+        self._count = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __contains__(self, event):
+        return event in self._events
+
+    def full(self):
+        return len(self._heap) >= self._maxsize
+
+    def push(self, event, queued):
+        """
+        Add an event, queued is the mtime of its queue file
+
+        Returns False if the queue is full
+        """
+        if event in self._events:
+            return True
+        if self.full():
+            return False
+
+        self._count += 1
+        if self._order == "oldest":
+            key = (queued, self._count)
+        else:
+            key = (self._count,)
+        heapq.heappush(self._heap, (key, event, queued))
+        self._events.add(event)
+        return True
+
+    def pop(self):
+        """
+        Return the next (event, queued) to process
+        """
+        _, event, queued = heapq.heappop(self._heap)
+        self._events.remove(event)
+        return (event, queued)
+
+
+def _worker(log, base_dir, job_rx, done_tx, queue_tx, timelapse, video):
+    """
+    Process the (event, threads, segment) jobs sent by the WorkerPool until it sends None
+
+    segment is None to process a finished event, or the next segment of an
+    in-progress event to encode.
+
+    The result, True unless it failed, and the metrics recorded while
+    processing each event are sent back with it.
+    """
+    # Only report the metrics from this process
+    Metrics.reset()
+    while True:
+        try:
+            # mp.connection.wait() uses the selectors gevent patches, so the logger's flush thread
+            # still runs while this is idle. recv() blocks the whole process, leaving the last
+            # event's log records unsent until the next event.
+            mp.connection.wait([job_rx])
+            job = job_rx.recv()
+        except EOFError:
+            break
+        if job is None:
+            break
+
+        event, threads, segment = job
+        ok = True
+        try:
+            if segment:
+                ok = process_segment(log, base_dir, event, segment, threads, video)
+            else:
+                process_event(log, base_dir, event, queue_tx, threads, timelapse, video)
+        except Exception as e:
+            log.error("process_event failed", queue_event=event, exception=str(e))
+            Metrics.inc("strix_process_event_total", result="error")
+            ok = False
+        done_tx.send((event, ok, Metrics.collect(reset=True)))
+
+
+class WorkerPool:
+    """
+    Long lived processes that run process_event()
+
+    Each worker is sent an event and replies with the event when it has
+    finished so that the next one can be handed to it. These use one-way
+    Pipes, duplex Pipes are sockets which gevent makes non-blocking.
+    """
+    def __init__(self, log, base_dir, size, queue_tx, timelapse="nth", video=None):
+        self._log = log
+        self._base_dir = base_dir
+        self._queue_tx = queue_tx
+        self._timelapse = timelapse
+        self._video = video
+        self._workers = {}
+        self._idle = []
+        self._busy = {}
+        for i in range(size):
+            self._start(i)
+
+    def _start(self, i):
+        job_rx, job_tx = mp.Pipe(False)
+        done_rx, done_tx = mp.Pipe(False)
+        worker = mp.Process(name=f"queue-worker-{i}",
+                            target=_worker,
+                            args=(self._log, self._base_dir, job_rx, done_tx, self._queue_tx,
+                                  self._timelapse, self._video))
+        worker.start()
+        job_rx.close()
+        done_tx.close()
+        self._workers[done_rx] = (i, worker, job_tx)
+        self._idle.append(done_rx)
+
+    def connections(self):
+        return list(self._busy)
+
+    def idle(self):
+        return len(self._idle)
+
+    def in_flight(self):
+        return list(self._busy.values())
+
+    def _restart(self, done_rx, event):
+        i, worker, job_tx = self._workers.pop(done_rx)
+        job_tx.close()
+        worker.join()
+        self._log.error("Worker died, restarting it", worker=worker.name, queue_event=event)
+        Metrics.inc("strix_queue_worker_restarts_total")
+        self._start(i)
+
+    def dispatch(self, event, threads=0, segment=None):
+        """
+        Send a job to an idle worker
+
+        Returns False if the worker had died while it was idle, it is restarted
+        and the job needs to be dispatched again.
+        """
+        done_rx = self._idle.pop()
+        try:
+            self._workers[done_rx][2].send((event, threads, segment))
+        except OSError:
+            self._restart(done_rx, event)
+            return False
+        self._busy[done_rx] = event
+        return True
+
+    def finished(self, done_rx):
+        """
+        Handle a reply from a worker, restarting it if it has died
+
+        Returns a tuple of the event it was working on and True if it succeeded
+        """
+        event = self._busy.pop(done_rx)
+        try:
+            _, ok, metrics = done_rx.recv()
+            Metrics.merge(metrics)
+            self._idle.append(done_rx)
+        except EOFError:
+            self._restart(done_rx, event)
+            ok = False
+        return (event, ok)
+
+    def close(self):
+        for _, _, job_tx in self._workers.values():
+            try:
+                job_tx.send(None)
+            except OSError:
+                pass
+        for _, worker, _ in self._workers.values():
+            worker.join()
+
+
+def monitor_queue(logging_queue, base_dir, quit, max_threads, queue_tx, queue_order="fifo", queue_size=1000,
+                  timelapse="nth", metrics_tx=None, video=None, incremental=False):
     log = logger.log(logging_queue)
 
+    # The metrics are sent to the API process over metrics_tx, skip any inherited from the parent
+    Metrics.reset()
+    metrics_sent = 0
+
     queue_path = os.path.abspath(os.path.join(base_dir, "queue/"))
-    log.info("Started queue monitor", queue_path=queue_path)
+    log.info("Started queue monitor", queue_path=queue_path, max_threads=max_threads,
+             queue_order=queue_order, queue_size=queue_size, video=video or VIDEO_ARGS, incremental=incremental)
+
+    # Wake up as soon as motion touches a new queue file, falling back to polling
+    try:
+        watcher = InotifyWatcher(queue_path)
+    except OSError as e:
+        log.info("inotify is not available, polling the queue", exception=str(e))
+        watcher = None
+
+    pool = WorkerPool(log, base_dir, max_threads, queue_tx, timelapse, video)
+    jobs = JobQueue(queue_order, queue_size)
+    budget = ThreadBudget(max_threads)
+    # Events with a segment being encoded, they are not processed until it is finished
+    segments = set()
+    segment_check = 0
+    # Events whose last segment failed, {event: (time of the next try, seconds to wait after that)}
+    segment_failed = {}
+    status = None
+
+    # Start by processing anything left in the queue
+    rescan = True
     while not quit.is_set():
-        time.sleep(5)
-        # Remove any threads from the list that have finished
-        for t in threads[:]:
-            if not t.is_alive():
-                threads.remove(t)
-
-        for event_file in glob(os.path.join(queue_path, "*")):
-            # Limit the number of processes to 1/2 the number of cpus (or 1)
-            if len(threads) >= max_threads:
-                break
+        # Files that didn't fit in the job queue are left in queue/ until there is room
+        if rescan:
+            rescan = False
+            for queued, event_file in sorted(queued_files(queue_path)):
+                if not jobs.push(os.path.split(event_file)[-1], queued):
+                    rescan = True
+                    break
+
+        # Hand the jobs to any idle workers, while there are cpus for them
+        held = []
+        while pool.idle() and jobs and budget.admit():
+            waiting = min(pool.idle(), len(jobs))
+            event, queued = jobs.pop()
+            if event in segments:
+                held.append((event, queued))
+                continue
+            try:
+                event_file = os.path.join(queue_path, event)
+                queued = os.stat(event_file).st_mtime
+            except FileNotFoundError:
+                continue
+            if not pool.dispatch(event, budget.acquire(event, event_frames(base_dir, event), waiting)):
+                # The queue file is only removed once a worker has the event
+                budget.release(event)
+                jobs.push(event, queued)
+                continue
+            try:
+                os.unlink(event_file)
+            except FileNotFoundError:
+                pass
+            Metrics.inc("strix_queue_events_total")
+            Metrics.observe("strix_queue_wait_seconds", max(0, time.time() - queued))
+        for event, queued in held:
+            jobs.push(event, queued)
+
+        # Encode segments of the events motion is recording when there is nothing else to do
+        if incremental and not jobs and pool.idle() and time.monotonic() - segment_check >= SEGMENT_CHECK:
+            segment_check = time.monotonic()
+            in_flight = pool.in_flight()
+            for event in in_progress_events(base_dir):
+                if not pool.idle() or not budget.admit():
+                    break
+                if event in in_flight or event in jobs:
+                    continue
+                if event in segment_failed and time.monotonic() < segment_failed[event][0]:
+                    continue
+                try:
+                    segment = next_segment(os.path.join(base_dir, event.replace("_", os.path.sep)), timelapse)
+                except OSError:
+                    continue
+                if not segment:
+                    continue
+                if pool.dispatch(event, budget.acquire(event, SEGMENT_FRAMES, 1), segment):
+                    segments.add(event)
+                else:
+                    budget.release(event)
+
+        if status != (len(jobs), len(pool.in_flight())):
+            status = (len(jobs), len(pool.in_flight()))
+            log.debug("Queue status", queue_depth=len(jobs), in_flight=pool.in_flight())
+            Metrics.set("strix_queue_depth", len(jobs))
+            Metrics.set("strix_queue_in_flight", len(pool.in_flight()))
+            Metrics.set("strix_queue_threads", budget.used())
+
+        # Send the totals to the API process, at most once a second
+        if metrics_tx and Metrics.changed() and time.monotonic() - metrics_sent >= 1:
+            metrics_tx.send(Metrics.collect())
+            metrics_sent = time.monotonic()
+
+        # The queue is scanned when nothing happens for 5 seconds, this is the polling when
+        # there is no watcher and catches anything the watcher missed.
+        ready = mp.connection.wait(pool.connections() + ([watcher] if watcher else []), timeout=5)
+        if not ready:
+            rescan = True
+        for r in ready:
+            if r is watcher:
+                events, overflow = watcher.read()
+                if overflow:
+                    log.info("inotify queue overflowed, scanning the queue")
+                    rescan = True
+                for event in events:
+                    try:
+                        queued = os.path.getmtime(os.path.join(queue_path, event))
+                    except OSError:
+                        continue
+                    if not jobs.push(event, queued):
+                        rescan = True
+            else:
+                event, ok = pool.finished(r)
+                budget.release(event)
+                if event not in segments:
+                    segment_failed.pop(event, None)
+                elif ok:
+                    # Look for the next one straight away, it may have fallen behind
+                    segments.discard(event)
+                    segment_failed.pop(event, None)
+                    segment_check = 0
+                else:
+                    # Back off on an event's segments that keep failing
+                    segments.discard(event)
+                    delay = segment_failed[event][1] if event in segment_failed else SEGMENT_RETRY_MIN
+                    segment_failed[event] = (time.monotonic() + delay, min(delay * 2, SEGMENT_RETRY_MAX))
+                    log.error("Encoding a segment failed, trying again later", queue_event=event, retry=delay)
 
-            os.unlink(event_file)
-            event = os.path.split(event_file)[-1]
-            thread = mp.Process(target=process_event, args=(log, base_dir, event, queue_tx))
-            threads.append(thread)
-            thread.start()
+    if watcher:
+        watcher.close()
 
     log.info("monitor_queue waiting for threads to finish")
-    for t in threads:
-        t.join()
+    pool.close()
 
     log.info("monitor_queue is quitting")
@@ -0,0 +1,128 @@
+# thumbnail.py
+#
+# Copyright (C) 2017 Brian C. Lane
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import json
+import os
+
+from PIL import Image
+
+# The thumbnails written to each event directory, largest first
+# thumbnail.jpg is the preview used by the UI, thumbnail-grid.jpg is for grids of events
+THUMBNAIL_SIZES = [
+    ("thumbnail.jpg",       (640, 480)),
+    ("thumbnail-grid.jpg",  (320, 240)),
+]
+
+# Sprite sheets of the event's frames, for scrubbing through them without fetching each image.
+# SPRITE_INDEX has the position of each frame's tile in the sheets.
+SPRITE_SHEET = "thumbnail-sprites-%d.jpg"
+SPRITE_INDEX = "sprites.json"
+SPRITE_WIDTH = 160
+SPRITE_COLUMNS = 10
+SPRITE_ROWS = 10
+
+# Longer events use every n'th frame so that they fit in 2 sheets
+SPRITE_MAX_FRAMES = 2 * SPRITE_COLUMNS * SPRITE_ROWS
+
+def is_thumbnail(filename):
+    """
+    Return True if the file is one of the thumbnails, not an event image
+    """
+    return os.path.basename(filename).startswith("thumbnail")
+
+
+def make_thumbnails(image_path, event_path, sizes=None):
+    """
+    Write the thumbnails for an event using image_path as the source
+
+    The JPEG is decoded in draft mode, letting libjpeg scale it down by
+    1/2, 1/4 or 1/8 while decoding, to the smallest size that is still
+    larger than the biggest thumbnail. Each smaller size is made from the
+    previous one.
+
+    Returns a list of the paths written
+    """
+    sizes = sorted(sizes or THUMBNAIL_SIZES, key=lambda s: s[1][0] * s[1][1], reverse=True)
+
+    written = []
+    with Image.open(image_path) as im:
+        im.draft("RGB", sizes[0][1])
+        im = im.convert("RGB")
+        for name, size in sizes:
+            im.thumbnail(size)
+            path = os.path.join(event_path, name)
+            im.save(path, "JPEG")
+            written.append(path)
+    return written
+
+
+def make_sprites(event_path, images, max_frames=SPRITE_MAX_FRAMES):
+    """
+    Write sprite sheets of the event's images, scaled down to SPRITE_WIDTH, and their index
+
+    images are the names of the event's images in order. The index has the
+    tile size, the sheet names and a list of frames, each with the image name,
+    sheet number and the x, y offset of its tile. Images that cannot be read
+    are left as a black tile.
+
+    Returns a list of the paths written
+    """
+    if not images:
+        return []
+
+    step = max(1, -(-len(images) // max_frames))
+    frames = images[::step]
+    # The tiles have the aspect ratio of the first image that can be read
+    for name in frames:
+        try:
+            with Image.open(os.path.join(event_path, name)) as im:
+                width, height = im.size
+            break
+        except OSError:
+            pass
+    else:
+        return []
+    tile =(SPRITE_WIDTH, max(1, round(SPRITE_WIDTH * height / width)))
+    per_sheet = SPRITE_COLUMNS * SPRITE_ROWS
+
+    written = []
+    index = {"width": tile[0], "height": tile[1], "columns": SPRITE_COLUMNS, "step": step,
+             "sheets": [], "frames": []}
+    for sheet, first in enumerate(range(0, len(frames), per_sheet)):
+        names = frames[first:first + per_sheet]
+        rows = -(-len(names) // SPRITE_COLUMNS)
+        sprites = Image.new("RGB", (tile[0] * min(len(names), SPRITE_COLUMNS), tile[1] * rows))
+        for i, name in enumerate(names):
+            x, y = tile[0] * (i % SPRITE_COLUMNS), tile[1] * (i // SPRITE_COLUMNS)
+            try:
+                with Image.open(os.path.join(event_path, name)) as im:
+                    # Let libjpeg do most of the scaling while decoding, like make_thumbnails()
+                    im.draft("RGB", tile)
+                    sprites.paste(im.convert("RGB").resize(tile), (x, y))
+            except OSError:
+                pass
+            index["frames"].append({"image": name, "sheet": sheet, "x": x, "y": y})
+
+        path = os.path.join(event_path, SPRITE_SHEET % sheet)
+        sprites.save(path, "JPEG")
+        index["sheets"].append(os.path.basename(path))
+        written.append(path)
+
+    path = os.path.join(event_path, SPRITE_INDEX)
+    with open(path, "w") as f:
+        json.dump(index, f)
+    written.append(path)
+    return written
@@ -0,0 +1,101 @@
+# test_events.py
+#
+# Copyright (C) 2017 Brian C. Lane
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from datetime import datetime, timedelta
+import unittest
+
+from gevent import monkey
+
+from strix.events import EventCacheClass
+
+# Importing strix monkey-patches threading, use native threads for the readers
+start_new_thread = monkey.get_original("_thread", "start_new_thread")
+allocate_lock = monkey.get_original("_thread", "allocate_lock")
+
+CAMERAS = ["Camera1", "Camera2", "Camera3"]
+EVENTS = 3000
+READERS = 4
+
+def event_details(start):
+    return {"start": start, "end": start + timedelta(seconds=30), "video": "video.m4v",
+            "debug_video": "debug/video.m4v", "thumbnail": "thumbnail.jpg", "saved": False}
+
+
+class EventSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = EventCacheClass()
+        self.now = datetime.now().replace(microsecond=0)
+
+    def check_snapshot(self, snapshot):
+        """
+        Check that a snapshot's index and records agree
+        """
+        for camera in CAMERAS:
+            index = snapshot.index.get(camera, ())
+            self.assertEqual(len(index), len(snapshot.records.get(camera, {})))
+            paths = snapshot.camera_range(camera, self.now - timedelta(days=31), self.now, 0, 50)
+            for path in paths:
+                self.assertEqual(snapshot.get(path)["start"].date().isoformat(), path.split("/")[-2])
+
+    def test_readers_and_writer(self):
+        """
+        Test that concurrent readers always see consistent snapshots while events are added and expired
+        """
+        errors = []
+        reads = [0]
+        stop = []
+
+        def reader(done):
+            try:
+                while not stop:
+                    self.check_snapshot(self.cache.snapshot())
+                    reads[0] += 1
+            except Exception as e:                  # pylint: disable=broad-except
+                errors.append(e)
+            finally:
+                done.release()
+
+        readers = []
+        for _ in range(READERS):
+            done = allocate_lock()
+            done.acquire()
+            start_new_thread(reader, (done,))
+            readers.append(done)
+
+        try:
+            for i in range(EVENTS):
+                # Spread the events over the last 30 days, out of order
+                start = self.now - timedelta(minutes=(i * 7919) % (30 * 24 * 60))
+                path = f"/tmp/strix-test/{CAMERAS[i % len(CAMERAS)]}/{start:%Y-%m-%d}/{start:%H-%M-%S}"
+                self.cache.set(path, event_details(start))
+                if i % 500 == 499:
+                    # The paths are outside the base_dir, so only the cache is changed
+                    self.cache.keep(30 - i // 500)
+                    self.cache.expire_events()
+        finally:
+            stop.append(True)
+            for done in readers:
+                done.acquire()
+
+        self.assertEqual(errors, [])
+        self.assertGreater(reads[0], 0)
+        self.check_snapshot(self.cache.snapshot())
+        self.assertEqual(len(self.cache.events()),
+                         sum(len(index) for index in self.cache.snapshot().index.values()))
+
+
+if __name__ == '__main__':
+    unittest.main()